@@ -0,0 +1,38 @@
+import verifytree.api as A
+import pytest
+import os
+
+
+class TestApi:
+
+    def _make_tree(self, tmpdir):
+        for d in ['a', 'b']:
+            sub = tmpdir.mkdir(d)
+            for i in range(3):
+                sub.join('f%d' % i).write(d*(i+1))
+        return str(tmpdir)
+
+    def test_findings_are_yielded_without_printing(self, tmpdir, capsys):
+        path = self._make_tree(tmpdir)
+        run = A.verify_tree(path, jobs=2)
+        kinds = [f.kind for f in run]
+        assert kinds.count('files_new') == 6
+        assert run.results.files_new == 6
+        assert run.progress.dirs_done == 3
+        assert run.progress.bytes_done == run.progress.bytes_total == 12
+        assert capsys.readouterr().out == ''
+
+        tmpdir.join('a').join('f0').write('x', mode='r+')
+        os.utime(str(tmpdir.join('a').join('f0')), (0, int(os.stat(str(tmpdir.join('a').join('f1'))).st_mtime)))
+        errors = [f for f in A.verify_tree(path) if f.kind == 'files_chksum_error']
+        assert [f.path for f in errors] == [str(tmpdir.join('a').join('f0'))]
+
+    def test_cancel(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        run = A.verify_tree(path)
+        for finding in run:
+            run.cancel()
+        assert run.cancelled
+        assert run.progress.dirs_done == 2
+        done = [d for d in 'ab' if tmpdir.join(d).join('.verifytree_checksum').exists()]
+        assert len(done) == 1
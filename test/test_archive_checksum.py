@@ -0,0 +1,133 @@
+import verifytree.archive_checksum as A
+import verifytree.check_dirs as C
+from verifytree.file_checksum import FileChecksum
+import pytest
+import os, errno, tarfile, zipfile
+
+from mock import patch
+
+
+class TestArchiveChecksum:
+
+    def setup(self):
+        self.fc = FileChecksum()
+        self.fc.show_progress = False
+        self.fc.blocksize = 4096
+        self.ac = A.ArchiveChecksum(self.fc)
+
+    def _make_members(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('a').write('a'*10000)
+        src.join('b').write('b'*10)
+        return src
+
+    @pytest.mark.parametrize('name,mode', [('t.tar', 'w'), ('t.tgz', 'w:gz'), ('t.tar.bz2', 'w:bz2')])
+    def test_tar_members(self, tmpdir, name, mode):
+        src = self._make_members(tmpdir)
+        archive = str(tmpdir.join(name))
+        with tarfile.open(archive, mode) as tar:
+            tar.add(str(src), 'src')
+        _hash, members = self.ac.get_hash(archive)
+        assert _hash == self.fc.get_hash(archive)
+        assert sorted(members) == ['src/a', 'src/b']
+        assert members['src/a']['size'] == 10000
+        assert members['src/b']['hash'] == self.fc.get_hash(str(src.join('b')))
+
+    def test_zip_members(self, tmpdir):
+        src = self._make_members(tmpdir)
+        archive = str(tmpdir.join('t.zip'))
+        z = zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED)
+        z.write(str(src.join('a')), 'a')
+        z.write(str(src.join('b')), 'b')
+        z.close()
+        _hash, members = self.ac.get_hash(archive)
+        assert _hash == self.fc.get_hash(archive)
+        assert members['a']['hash'] == self.fc.get_hash(str(src.join('a')))
+
+    @pytest.mark.parametrize('io_mode,read_ahead', [('nocache', 0), ('nocache', 4), ('direct', 4)])
+    def test_archive_is_read_like_other_files(self, tmpdir, io_mode, read_ahead):
+        src = self._make_members(tmpdir)
+        src.join('c').write_binary(os.urandom(50000))
+        for name, mode in [('t.tgz', 'w:gz'), ('t.zip', None)]:
+            archive = str(tmpdir.join(name))
+            if mode is None:
+                z = zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED)
+                for m in 'abc':
+                    z.write(str(src.join(m)), m)
+                z.close()
+            else:
+                with tarfile.open(archive, mode) as tar:
+                    tar.add(str(src), 'src')
+            self.fc.io_mode = io_mode
+            self.fc.read_ahead = read_ahead
+            with patch.object(FileChecksum, 'iter_chunks', autospec=True, side_effect=FileChecksum.iter_chunks) as iter_chunks:
+                _hash, members = self.ac.get_hash(archive)
+            assert iter_chunks.call_count == 1
+            assert len(members) == 3
+            assert members[sorted(members)[2]]['hash'] == self.fc.get_hash(str(src.join('c')))
+            self.fc.io_mode = 'buffered'
+            assert _hash == self.fc.get_hash(archive)
+
+    def test_unreadable_zip_members_are_skipped(self, tmpdir):
+        archive = str(tmpdir.join('t.zip'))
+        z = zipfile.ZipFile(archive, 'w')
+        secret = zipfile.ZipInfo('secret')
+        secret.flag_bits |= 0x1 # Encrypted, so it needs a password
+        z.writestr(secret, 'x'*100)
+        z.writestr('plain', 'y'*10)
+        z.close()
+        _hash, members = self.ac.get_hash(archive)
+        assert _hash == self.fc.get_hash(archive)
+        assert sorted(members) == ['plain']
+
+    def test_not_an_archive(self, tmpdir):
+        f = tmpdir.join('junk.tar')
+        f.write('x'*100)
+        assert self.ac.get_hash(str(f)) == (self.fc.get_hash(str(f)), None)
+        assert self.ac.get_hash(str(tmpdir.join('missing.tar'))) is None
+
+    def test_read_errors_are_retried(self, tmpdir):
+        src = self._make_members(tmpdir)
+        archive = str(tmpdir.join('t.tar'))
+        with tarfile.open(archive, 'w') as tar:
+            tar.add(str(src), 'src')
+        real_iter_chunks = self.fc.iter_chunks
+        failures = [IOError(errno.EIO, 'Input/output error')]
+        def flaky(filename, filesize):
+            if failures:
+                raise failures.pop()
+            return real_iter_chunks(filename, filesize)
+        with patch.object(self.fc, 'iter_chunks', side_effect=flaky), patch('time.sleep') as sleep:
+            _hash, members = self.ac.get_hash(archive)
+        assert _hash == self.fc.get_hash(archive)
+        assert sorted(members) == ['src/a', 'src/b']
+        assert [c[0][0] for c in sleep.call_args_list] == [1.0]
+
+    def test_damaged_member_is_reported(self, tmpdir):
+        src = self._make_members(tmpdir)
+        tree = tmpdir.mkdir('tree')
+        archive = str(tree.join('t.tar'))
+        with tarfile.open(archive, 'w') as tar:
+            tar.add(str(src), 'src')
+        os.utime(archive, (1e9, 1e9)) # Saved mtimes only compare to the second
+
+        checker = C.CheckDirs()
+        checker.quiet = True
+        checker.update_hash_files = True
+        checker.archives = True
+        list(checker.iter_validate(str(tree)))
+
+        # Flip a byte in the middle of member a, without changing the size or mtime
+        with open(archive, 'r+b') as f:
+            data = f.read()
+            offset = data.index('a'*10000) + 5000
+            f.seek(offset)
+            f.write('z')
+        os.utime(archive, (1e9, 1e9))
+
+        findings = []
+        checker.listener = findings.append
+        results = list(checker.iter_validate(str(tree)))
+        assert results[0].results.files_chksum_error == 1
+        assert [(f.kind, f.path) for f in findings if f.kind == 'files_chksum_error'] == \
+               [('files_chksum_error', os.path.join(archive, 'src/a'))]
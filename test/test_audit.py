@@ -0,0 +1,116 @@
+import verifytree.audit as A
+import verifytree.check_dirs as C
+from verifytree.hash_engine import HashEngine
+from verifytree.path_filter import PathFilter
+import pytest
+import os, random
+
+
+class TestAudit:
+
+    def test_wilson_interval(self):
+        low, high = A.wilson_interval(0, 10)
+        assert low == 0.0 and abs(high - 0.2775) < 1e-4
+        low, high = A.wilson_interval(5, 100)
+        assert abs(low - 0.0215) < 1e-4 and abs(high - 0.1118) < 1e-4
+        assert A.wilson_interval(0, 0) == (0.0, 1.0)
+
+    def test_reservoir_weights_by_size(self):
+        picked = dict((name, 0) for name in 'ab')
+        rng = random.Random(1)
+        for i in range(2000):
+            sample = A.Reservoir(1, rng)
+            sample.add('a', 1)
+            sample.add('b', 9)
+            picked[sample.items[0]] += 1
+        assert 1600 < picked['b'] < 2000
+
+        sample = A.Reservoir(3, rng)
+        for i in range(10):
+            sample.add(i)
+        assert len(set(sample.items)) == 3
+
+    def test_weighted_draws_are_with_replacement(self):
+        rng = random.Random(1)
+        sample = A.WeightedDraws(10000, rng)
+        for name, weight in [('a', 1), ('b', 6), ('c', 3)]:
+            sample.add(name, weight)
+        picked = sample.items
+        assert len(picked) == 10000
+        assert [abs(picked.count(name) / 10000.0 - share) < 0.02 for name, share in [('a', .1), ('b', .6), ('c', .3)]] == [True] * 3
+        assert A.WeightedDraws(3, rng).items == []
+
+    def _make_tree(self, tmpdir):
+        for d in ('.', 'sub'):
+            for i in range(5):
+                f = tmpdir.join(d, 'f%d' % i)
+                f.write('x' * (i + 1) * 100, ensure=True)
+                os.utime(str(f), (1e9, 1e9))
+        checker = C.CheckDirs()
+        checker.quiet = True
+        checker.update_hash_files = True
+        list(checker.iter_validate(str(tmpdir)))
+        return str(tmpdir)
+
+    def test_audit_counts_failures(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        damaged = tmpdir.join('sub', 'f2')
+        damaged.write('y' * 300)
+        os.utime(str(damaged), (1e9, 1e9)) # Same size and mtime, different contents
+        tmpdir.join('f0').write('changed')
+        tmpdir.join('f1').remove()
+
+        engine = HashEngine()
+        engine.show_progress = False
+        results = A.Audit(engine).audit(path, 100, seed=1)
+        assert (results.population_files, results.population_bytes) == (10, 3000)
+        assert (results.sampled, results.validated, results.chksum_error, results.changed, results.missing) == (10, 7, 1, 1, 1)
+        assert results.failed == [(str(damaged), 'chksum_error')]
+        low, high = results.interval
+        assert low < results.rate == 1.0/8 < high
+
+    def test_audit_sample_is_repeatable(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        engine = HashEngine()
+        engine.show_progress = False
+        audit = A.Audit(engine)
+        hashed = []
+        engine.hash_files = lambda filenames, sizes, inos=None: hashed.append(filenames) or [None] * len(filenames)
+        audit.audit(path, 3, by_size=True, seed=7)
+        audit.audit(path, 3, by_size=True, seed=7)
+        assert len(hashed[0]) == 3 and hashed[0] == hashed[1]
+
+    def test_records_skip_filtered_sizes(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        audit = A.Audit(HashEngine())
+        audit.path_filter = PathFilter(['sub/'], min_size=300)
+        assert sorted(os.path.basename(f) for f, entry in audit.records(path)) == ['f2', 'f3', 'f4']
+
+    def test_audit_by_size_estimates_share_of_bytes(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        damaged = tmpdir.join('sub', 'f4')
+        damaged.write('y' * 500)
+        os.utime(str(damaged), (1e9, 1e9)) # 500 of the 3000 bytes
+
+        engine = HashEngine()
+        engine.show_progress = False
+        hashed = []
+        real_hash_files = engine.hash_files
+        engine.hash_files = lambda filenames, sizes, inos=None: hashed.extend(filenames) or real_hash_files(filenames, sizes, inos=inos)
+        results = A.Audit(engine).audit(path, 4000, by_size=True, seed=1)
+        assert results.sampled == results.checked == 4000
+        assert len(hashed) == len(set(hashed)) == 10 # Each file hashed once, however many times it was drawn
+        assert results.failed == [(str(damaged), 'chksum_error')]
+        low, high = results.interval
+        assert abs(results.rate - 500.0/3000) < 0.02
+        assert low < 500.0/3000 < high
+
+    def test_records_do_not_follow_symlinked_dirs(self, tmpdir):
+        path = self._make_tree(tmpdir.mkdir('tree'))
+        tmpdir.join('tree', 'sub', 'loop').mksymlinkto(tmpdir.join('tree')) # Would loop forever if followed
+        checker = C.CheckDirs()
+        checker.quiet = True
+        checker.update_hash_files = True
+        list(checker.iter_validate(path))
+        assert 'loop' in C.ChecksumStore().load(str(tmpdir.join('tree', 'sub', checker.dbname)))['dirs']
+        assert len(list(A.Audit(HashEngine()).records(path))) == 10
@@ -0,0 +1,79 @@
+import verifytree.block_tuner as B
+from verifytree.hash_engine import HashEngine
+import pytest
+import os
+
+from mock import patch
+
+
+class TestBlockTuner:
+
+    def _tune(self, tuner, dev, speeds):
+        """ Hash files on dev, taking 1s per file at each block size's speed (bytes/s) """
+        size = B.MIN_TRIAL_SIZE
+        while dev not in tuner.tuned:
+            blocksize = tuner.blocksize(dev, size)
+            tuner.record(dev, blocksize, size, float(size) / speeds[blocksize])
+
+    @patch('verifytree.block_tuner.mount_key', {7: '/a (ext4)', 8: '/b (nfs)', 9: '/a (ext4)'}.get)
+    def test_picks_fastest_and_saves_it(self, tmpdir):
+        tuning_file = str(tmpdir.join('tuning.yaml'))
+        tuner = B.BlockTuner(tuning_file, default=4096)
+        assert tuner.blocksize(7, 1000) == 4096 # Too small to time
+        speeds = dict((b, 100 * b) for b in B.CANDIDATES)
+        speeds[262144] = 10**12
+        self._tune(tuner, 7, speeds)
+        assert tuner.blocksize(7, 1000) == 262144
+        assert tuner.blocksize(8, 1000) == 4096
+
+        # Another run starts off with it, even if the mount got a new st_dev
+        tuner = B.BlockTuner(tuning_file)
+        assert tuner.blocksize(9, 1000) == 262144
+        self._tune(tuner, 8, dict((b, b) for b in B.CANDIDATES))
+        assert B.BlockTuner(tuning_file)._saved == {'/a (ext4)': 262144, '/b (nfs)': 4194304}
+
+    @patch('verifytree.block_tuner.mount_key', lambda dev: None)
+    def test_unknown_mount_is_not_saved(self, tmpdir):
+        tuning_file = tmpdir.join('tuning.yaml')
+        tuner = B.BlockTuner(str(tuning_file))
+        self._tune(tuner, 7, dict((b, b) for b in B.CANDIDATES))
+        assert tuner.blocksize(7, 1000) == 4194304
+        assert not tuning_file.check()
+
+    def test_mount_key_from_mountinfo(self, tmpdir):
+        mountinfo = tmpdir.join('mountinfo')
+        mountinfo.write('\n'.join([
+            '23 28 0:22 / /proc rw,relatime - proc proc rw',
+            '40 28 8:17 /photos /srv/bind rw shared:5 - ext4 /dev/sdb1 rw',
+            '41 28 8:17 / /mnt/my\\040disk rw,relatime shared:5 - ext4 /dev/sdb1 rw',
+            '42 28 0:50 / /mnt/nas rw - nfs4 nas:/export rw',
+        ]))
+        assert B.mount_key(os.makedev(8, 17), str(mountinfo)) == '/mnt/my disk (ext4)'
+        assert B.mount_key(os.makedev(0, 50), str(mountinfo)) == '/mnt/nas (nfs4)'
+        assert B.mount_key(os.makedev(8, 18), str(mountinfo)) is None
+        assert B.mount_key(os.makedev(8, 17), str(tmpdir.join('missing'))) is None
+
+    def test_bad_tuning_file_is_ignored(self, tmpdir):
+        tuning_file = tmpdir.join('tuning.yaml')
+        tuning_file.write('devices: [')
+        assert B.BlockTuner(str(tuning_file))._saved == {}
+
+    def test_engine_reads_with_tuned_blocksize(self, tmpdir):
+        f = tmpdir.join('f')
+        f.write('x' * 300000)
+        dev = os.stat(str(f)).st_dev
+        tuner = B.BlockTuner(None)
+        tuner.tuned[dev] = 65536
+        engine = HashEngine()
+        engine.show_progress = False
+        engine.tuner = tuner
+        sizes = []
+        shared_blocksize = engine.fc.blocksize
+        real_get_hash = engine.fc.get_hash
+        def get_hash(self, filename, size=None):
+            sizes.append(self.blocksize)
+            return real_get_hash(filename, size)
+        with patch('verifytree.file_checksum.FileChecksum.get_hash', autospec=True, side_effect=get_hash):
+            assert engine.hash_files([str(f)], [300000]) == [real_get_hash(str(f), 300000)]
+        assert sizes == [65536]
+        assert engine.fc.blocksize == shared_blocksize # The shared one is left alone
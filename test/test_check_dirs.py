@@ -0,0 +1,220 @@
+import verifytree.check_dirs as C
+from verifytree.file_checksum import FileChecksum
+import pytest
+import os, threading
+
+from mock import patch
+
+
+class TestCheckDirs:
+
+    def setup(self):
+        self.c = C.CheckDirs()
+
+    def _make_tree(self, tmpdir):
+        tmpdir.join('f1').write('a'*10)
+        sub = tmpdir.mkdir('sub')
+        sub.join('f2').write('b'*20)
+        sub.join('f3').write('c'*30)
+        return str(tmpdir)
+
+    def _age_dirs(self, *dirs):
+        # A listing made right after the directory changed isn't trusted by the fast scan
+        for d in dirs:
+            os.utime(str(d), (1e9, 1e9))
+
+    def _validate(self, path):
+        self.c.scan(path)
+        self.c.validate(path)
+
+    def test_fast_scan_reuses_saved_listing(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        self._age_dirs(tmpdir, tmpdir.join('sub'))
+        self.c.fast_scan = True
+        self._validate(path)
+
+        with patch('os.listdir', wraps=os.listdir) as listdir:
+            assert self.c.scan(path) == (2, 3, 60)
+        assert listdir.call_count == 0
+
+        # A new file changes the directory mtime, so that one gets listed again
+        tmpdir.join('sub').join('f4').write('d'*40)
+        with patch('os.listdir', wraps=os.listdir) as listdir:
+            assert self.c.scan(path) == (2, 4, 100)
+        assert listdir.call_count == 1
+
+    def test_slow_scan_counts_files(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        assert self.c.scan(path) == (2, 3, 60)
+
+    def test_lookahead_yields_in_walk_order(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        self.c.quiet = True
+        self.c.engine = C.HashEngine(3)
+        self.c.lookahead_bytes = 2**30
+        results = list(self.c.iter_validate(path))
+        assert [r.path for r in results] == [path, os.path.join(path, 'sub')]
+        assert [r.results.files_new for r in results] == [1, 2]
+        assert os.path.isfile(os.path.join(path, 'sub', self.c.dbname))
+
+    def test_from_list_only_touches_listed_entries(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        os.utime(str(tmpdir.join('sub', 'f2')), (1e9, 1e9)) # Saved mtimes only compare to the second
+        self.c.quiet = True
+        self.c.update_hash_files = True
+        list(self.c.iter_validate(path))
+
+        sub = tmpdir.join('sub')
+        sub.join('f4').write('d'*40)
+        sub.join('f3').remove()
+        tmpdir.join('f5').write('e') # Not listed, so it isn't picked up
+        self._age_dirs(sub)
+        self.c.fast_scan = True # So writing sub's checksum file keeps its mtime
+        with patch('os.listdir', wraps=os.listdir) as listdir:
+            results = list(self.c.iter_validate_listed(path, ['sub/f2', 'sub/f3', os.path.join(path, 'sub', 'f4')]))
+        assert [r.path for r in results] == [str(sub)]
+        r = results[0].results
+        assert (r.files_validated, r.files_deleted, r.files_new, r.files_total) == (1, 1, 1, 3)
+        assert listdir.call_count == 1 # Just to see if the saved listing still matches
+
+        # sub's saved listing is up to date again, so only the top gets listed
+        with patch('os.listdir', wraps=os.listdir) as listdir:
+            assert self.c.scan(path) == (2, 4, 71)
+        assert listdir.call_count == 1
+
+    def test_fast_scan_does_not_trust_a_racy_listing(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        self.c.quiet = True
+        self.c.fast_scan = True
+        self.c.update_hash_files = True
+        list(self.c.iter_validate(path))
+        # sub was changed just before it was listed, so another file may have gone in unseen
+        hashes = C.ChecksumStore().load(str(tmpdir.join('sub', self.c.dbname)))
+        assert 'dir_stat' not in hashes
+
+        self._age_dirs(tmpdir.join('sub'))
+        list(self.c.iter_validate(path))
+        hashes = C.ChecksumStore().load(str(tmpdir.join('sub', self.c.dbname)))
+        assert hashes['dir_stat']['mtime_ns'] == 1e18
+
+    def test_from_list_in_new_directory_only_hashes_listed_files(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        self.c.quiet = True
+        with patch.object(FileChecksum, 'get_hash', autospec=True, side_effect=FileChecksum.get_hash) as get_hash:
+            results = list(self.c.iter_validate_listed(path, ['sub/f2']))
+        assert [args[1] for args, kw in get_hash.call_args_list] == [str(tmpdir.join('sub', 'f2'))]
+        assert results[0].results.files_new == 1
+        hashes = results[0].store.load(str(tmpdir.join('sub', self.c.dbname)))
+        assert list(hashes['files']) == ['f2']
+
+    def test_validating_stats_each_file_once(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        for f in ('f1', 'sub/f2', 'sub/f3'):
+            os.utime(os.path.join(path, f), (1e9, 1e9)) # Saved mtimes only compare to the second
+        self.c.quiet = True
+        list(self.c.iter_validate(path))
+        with patch('os.stat', wraps=os.stat) as stat:
+            results = list(self.c.iter_validate(path))
+        assert sum(r.results.files_validated for r in results) == 3
+        paths = [args[0] for args, kw in stat.call_args_list]
+        # Once by os.walk to tell files from directories, and once to check and hash it
+        assert [paths.count(os.path.join(path, f)) for f in ('f1', 'sub/f2', 'sub/f3')] == [2, 2, 2]
+
+    def test_checksum_tmp_files_are_not_new_files(self, tmpdir):
+        tmpdir.join('f1').write('a')
+        tmpdir.join(self.c.dbname + '.tmp.%d' % os.getpid()).write('not synced yet')
+        self.c.quiet = True
+        results = list(self.c.iter_validate(str(tmpdir)))
+        assert (results[0].results.files_new, results[0].results.files_total) == (1, 1)
+
+    def test_detect_moves_reuses_hash(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        tmpdir.mkdir('other')
+        for f in ('f1', 'sub/f2', 'sub/f3'):
+            os.utime(os.path.join(path, f), (1e9, 1e9)) # Saved mtimes only compare to the second
+        self.c.quiet = True
+        self.c.update_hash_files = True
+        self.c.detect_moves = True
+        list(self.c.iter_validate(path))
+
+        os.rename(str(tmpdir.join('sub', 'f2')), str(tmpdir.join('other', 'f2b')))
+        tmpdir.join('other').join('f4').write('d'*40)
+        os.utime(os.path.join(path, 'other', 'f4'), (1e9, 1e9))
+        real_get_hash = FileChecksum.get_hash
+        with patch.object(FileChecksum, 'get_hash', autospec=True, side_effect=real_get_hash) as get_hash:
+            results = list(self.c.iter_validate(path))
+        hashed = [c[0][1] for c in get_hash.call_args_list]
+        assert os.path.join(path, 'other', 'f2b') not in hashed
+        assert os.path.join(path, 'other', 'f4') in hashed
+        totals = dict((k, sum(getattr(r.results, k) for r in results))
+                      for k in ('files_moved', 'files_deleted', 'files_new', 'files_validated'))
+        assert totals == dict(files_moved=1, files_deleted=0, files_new=1, files_validated=2)
+
+        # The moved file kept its hash, so it validates where it is now
+        self.c.detect_moves = False
+        results = list(self.c.iter_validate(path))
+        assert sum(r.results.files_validated for r in results) == 4
+
+    def test_detect_moves_into_new_directory_with_fsync_batch(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        self.c.quiet = True
+        self.c.update_hash_files = True
+        self.c.detect_moves = True
+        self.c.fsync_batch = 100
+        list(self.c.iter_validate(path))
+
+        new = tmpdir.mkdir('new')
+        new.join('f5').write('e'*50)
+        os.rename(str(tmpdir.join('sub', 'f2')), str(new.join('f2')))
+        results = list(self.c.iter_validate(path))
+        totals = dict((k, sum(getattr(r.results, k) for r in results)) for k in ('files_moved', 'files_new'))
+        assert totals == dict(files_moved=1, files_new=1)
+        hashes = C.ChecksumStore().load(str(new.join(self.c.dbname)))
+        assert sorted(hashes['files']) == ['f2', 'f5']
+
+    def test_stalled_files_get_their_own_count(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        self.c.quiet = True
+        self.c.engine.stall_timeout = 0.2
+        self.c.engine.fc.retries = 0
+        hung = threading.Event()
+        real_get_hash = FileChecksum.get_hash
+        def get_hash(fc, filename, size=None):
+            if filename.endswith('f3'):
+                hung.wait()
+            return real_get_hash(fc, filename, size)
+        try:
+            with patch.object(FileChecksum, 'get_hash', autospec=True, side_effect=get_hash):
+                results = list(self.c.iter_validate(path))
+        finally:
+            hung.set()
+        r = results[1].results
+        assert (r.files_new, r.files_stalled, r.files_disk_error) == (2, 1, 0)
+
+    def test_stalled_recorded_file_keeps_its_hash(self, tmpdir):
+        path = self._make_tree(tmpdir)
+        os.utime(str(tmpdir.join('sub', 'f3')), (1e9, 1e9)) # Saved mtimes only compare to the second
+        self.c.quiet = True
+        list(self.c.iter_validate(path))
+        checksum_file = str(tmpdir.join('sub', self.c.dbname))
+        recorded = C.ChecksumStore().load(checksum_file)['files']['f3']['hash']
+
+        self.c = C.CheckDirs()
+        self.c.quiet = True
+        self.c.force_update_hash_files = True
+        self.c.engine.stall_timeout = 0.2
+        self.c.engine.fc.retries = 0
+        hung = threading.Event()
+        real_get_hash = FileChecksum.get_hash
+        def get_hash(fc, filename, size=None):
+            if filename.endswith('f3'):
+                hung.wait()
+            return real_get_hash(fc, filename, size)
+        try:
+            with patch.object(FileChecksum, 'get_hash', autospec=True, side_effect=get_hash):
+                results = list(self.c.iter_validate(path))
+        finally:
+            hung.set()
+        r = results[1].results
+        assert (r.files_stalled, r.files_chksum_error, r.files_validated) == (1, 0, 0)
+        assert C.ChecksumStore().load(checksum_file)['files']['f3']['hash'] == recorded
@@ -0,0 +1,54 @@
+import verifytree.checksum_files as C
+import pytest
+import os
+import StringIO
+import xxhash
+
+
+class TestChecksumFiles:
+
+    def setup(self):
+        self.c = C.ChecksumFiles(C.HashEngine(2))
+        self.c.out = StringIO.StringIO()
+        self.c.err = StringIO.StringIO()
+
+    def _make_files(self, tmpdir):
+        names = []
+        for i, name in enumerate(['a', 'b c', 'back\\slash', 'new\nline']):
+            f = tmpdir.join(name)
+            f.write(os.urandom(i*50000), mode='wb')
+            names.append(str(f))
+        return names
+
+    def test_checksum_then_check(self, tmpdir):
+        names = self._make_files(tmpdir)
+        assert self.c.checksum(names + [str(tmpdir.join('missing'))]) == 1
+        lines = self.c.out.getvalue().splitlines(True)
+        assert lines[0] == '%s  %s\n' % (xxhash.xxh64(open(names[0], 'rb').read()).hexdigest(), names[0])
+        assert lines[2].startswith('\\')
+        assert [C.parse_line(l)[1] for l in lines] == names
+
+        self.c.out = StringIO.StringIO()
+        assert self.c.check(lines) == (0, 0)
+        assert self.c.out.getvalue().count(': OK\n') == 4
+
+        tmpdir.join('b c').write('changed')
+        os.remove(names[0])
+        self.c.out = StringIO.StringIO()
+        assert self.c.check(lines + ['not a checksum line\n']) == (1, 1)
+        assert '%s: FAILED\n' % names[1] in self.c.out.getvalue()
+        assert '%s: FAILED open or read\n' % names[0] in self.c.out.getvalue()
+        assert 'improperly formatted' in self.c.err.getvalue()
+
+    def test_small_batches_keep_order(self, tmpdir):
+        names = self._make_files(tmpdir)
+        self.c.batch_files = 3
+        self.c.checksum(names)
+        assert [C.parse_line(l)[1] for l in self.c.out.getvalue().splitlines(True)] == names
+
+    def test_read_file_list(self):
+        assert list(C.read_file_list(StringIO.StringIO('a\nb c\n\n'))) == ['a', 'b c']
+        assert list(C.read_file_list(StringIO.StringIO('a\nb\0c d\0'), null=True)) == ['a\nb', 'c d']
+
+    def test_parse_binary_marker(self):
+        assert C.parse_line('ABCD *some file\n') == ('abcd', 'some file')
@@ -0,0 +1,59 @@
+import verifytree.checksum_store as S
+import pytest
+import os
+
+from mock import patch
+
+
+class TestChecksumStore:
+
+    def setup(self):
+        self.store = S.ChecksumStore()
+
+    def test_save_is_deferred_until_commit(self, tmpdir):
+        checksum_file = str(tmpdir.join('.verifytree_checksum'))
+        self.store.save({'dirs': [], 'files': {}}, checksum_file)
+        self.store.save({'dirs': ['a'], 'files': {}}, checksum_file)
+        assert not os.path.exists(checksum_file)
+        assert self.store.load(checksum_file) == {'dirs': ['a'], 'files': {}}
+
+        with patch.object(S.ChecksumStore, '_write_tmp', wraps=self.store._write_tmp) as write:
+            self.store.commit(checksum_file)
+        assert write.call_count == 1
+        assert self.store.load(checksum_file) == {'dirs': ['a'], 'files': {}}
+        assert tmpdir.listdir() == [tmpdir.join('.verifytree_checksum')]
+
+    def test_commit_without_changes_does_not_write(self, tmpdir):
+        checksum_file = str(tmpdir.join('.verifytree_checksum'))
+        self.store.commit(checksum_file)
+        assert not os.path.exists(checksum_file)
+
+    def test_fsync_batch(self, tmpdir):
+        store = S.ChecksumStore(fsync_batch=2)
+        files = [str(tmpdir.mkdir(d).join('.verifytree_checksum')) for d in 'abc']
+        for f in files:
+            store.save({'dirs': [], 'files': {}}, f)
+            store.commit(f)
+        # First two were synced together, last one is waiting for close()
+        assert [os.path.exists(f) for f in files] == [True, True, False]
+        store.close()
+        assert os.path.exists(files[2])
+
+    def test_stale_tmp_files_are_left_out_and_removed(self, tmpdir):
+        checksum_file = str(tmpdir.join('.verifytree_checksum'))
+        tmpdir.join('f1').write('a')
+        tmpdir.join('.verifytree_checksum.tmp.%d' % os.getpid()).write('mine')
+        with patch('os.kill', side_effect=OSError(S.errno.ESRCH, 'No such process')):
+            tmpdir.join('.verifytree_checksum.tmp.99999').write('crashed')
+            files = self.store.without_tmp_files(checksum_file, os.listdir(str(tmpdir)))
+        assert files == ['f1']
+        assert sorted(os.listdir(str(tmpdir))) == ['.verifytree_checksum.tmp.%d' % os.getpid(), 'f1']
+
+    @pytest.mark.parametrize('keep_dir_mtime', [False, True])
+    def test_dir_mtime_only_kept_for_fast_scan(self, tmpdir, keep_dir_mtime):
+        checksum_file = str(tmpdir.join('.verifytree_checksum'))
+        os.utime(str(tmpdir), (1e9, 1e9))
+        store = S.ChecksumStore(keep_dir_mtime=keep_dir_mtime)
+        store.save({'dirs': [], 'files': {}, 'dir_stat': S.get_dir_stat(str(tmpdir))}, checksum_file)
+        store.close()
+        assert (os.stat(str(tmpdir)).st_mtime == 1e9) == keep_dir_mtime
@@ -0,0 +1,95 @@
+import verifytree.file_checksum as F
+import pytest
+import os, errno, threading
+import xxhash
+
+from mock import patch
+
+
+class TestFileChecksum:
+
+    def setup(self):
+        self.fc = F.FileChecksum()
+        self.fc.show_progress = False
+
+    @pytest.mark.parametrize('io_mode', F.IO_MODES)
+    @pytest.mark.parametrize('size', [0, 1, 4096, 65536, 65537, 300000])
+    def test_hash_matches_whole_file_digest(self, tmpdir, size, io_mode):
+        self.fc.io_mode = io_mode
+        data = os.urandom(size)
+        f = tmpdir.join('f')
+        f.write(data, mode='wb')
+        assert self.fc.get_hash(str(f)) == xxhash.xxh64(data).hexdigest()
+
+    def test_small_file_that_grew_since_stat(self, tmpdir):
+        data = os.urandom(100000)
+        f = tmpdir.join('f')
+        f.write(data, mode='wb')
+        assert self.fc.get_hash(str(f), filesize=10) == xxhash.xxh64(data).hexdigest()
+
+    def test_direct_io_falls_back_when_not_supported(self, tmpdir):
+        data = os.urandom(300000)
+        f = tmpdir.join('f')
+        f.write(data, mode='wb')
+        real_open = os.open
+        def no_direct_open(path, flags, *args):
+            if flags & getattr(os, 'O_DIRECT', 0):
+                raise OSError(errno.EINVAL, 'Invalid argument')
+            return real_open(path, flags, *args)
+        self.fc.io_mode = 'direct'
+        with patch('os.open', side_effect=no_direct_open):
+            assert self.fc.get_hash(str(f)) == xxhash.xxh64(data).hexdigest()
+
+    def test_missing_file(self, tmpdir):
+        assert self.fc.get_hash(str(tmpdir.join('nope')), filesize=10) is None
+
+    @pytest.mark.parametrize('io_mode', F.IO_MODES)
+    @pytest.mark.parametrize('read_ahead', [0, 1, 3])
+    def test_read_ahead_matches_whole_file_digest(self, tmpdir, io_mode, read_ahead):
+        self.fc.io_mode = io_mode
+        self.fc.read_ahead = read_ahead
+        self.fc.blocksize = 4096 # Lots of chunks, so the ring of buffers gets reused
+        data = os.urandom(300001)
+        f = tmpdir.join('f')
+        f.write(data, mode='wb')
+        assert self.fc.get_hash(str(f)) == xxhash.xxh64(data).hexdigest()
+
+    def test_read_ahead_reader_stops_when_abandoned(self, tmpdir):
+        self.fc.read_ahead = 2
+        self.fc.blocksize = 4096
+        f = tmpdir.join('f')
+        f.write(os.urandom(300000), mode='wb')
+        threads = threading.active_count()
+        chunks = self.fc._iter_file_read_ahead(str(f))
+        next(chunks)
+        assert threading.active_count() == threads + 1
+        chunks.close()
+        assert threading.active_count() == threads
+
+    def test_read_ahead_raises_read_errors(self, tmpdir):
+        def failing(filename, buffers):
+            yield buffer('x')
+            raise IOError(errno.EIO, 'Input/output error')
+        self.fc.read_ahead = 2
+        self.fc.retries = 0
+        with patch.object(self.fc, '_iter_file_into', side_effect=failing):
+            assert self.fc.get_hash(str(tmpdir.join('f')), filesize=100000) is None
+
+    def test_read_errors_are_retried(self, tmpdir):
+        data = os.urandom(1000)
+        f = tmpdir.join('f')
+        f.write(data, mode='wb')
+        real_read_hash = self.fc._read_hash
+        failures = [IOError(errno.EIO, 'Input/output error')] * 2
+        def flaky(filename, filesize):
+            if failures:
+                raise failures.pop()
+            return real_read_hash(filename, filesize)
+        with patch.object(self.fc, '_read_hash', side_effect=flaky), patch('time.sleep') as sleep:
+            assert self.fc.get_hash(str(f)) == xxhash.xxh64(data).hexdigest()
+        assert [c[0][0] for c in sleep.call_args_list] == [1.0, 2.0]
+
+        failures[:] = [IOError(errno.EIO, 'Input/output error')] * 3
+        with patch.object(self.fc, '_read_hash', side_effect=flaky), patch('time.sleep'):
+            assert self.fc.get_hash(str(f)) is None
+        assert failures == [] # Gave up after the retries
@@ -0,0 +1,153 @@
+import verifytree.hash_engine as H
+import pytest
+import os, errno, threading
+import xxhash
+
+from mock import patch
+
+
+class TestHashEngine:
+
+    def _make_files(self, tmpdir, n):
+        files = []
+        for i in range(n):
+            f = tmpdir.join('f%02d' % (n-i))
+            f.write(os.urandom(i*10000), mode='wb')
+            files.append(str(f))
+        return files, [os.path.getsize(f) for f in files]
+
+    @pytest.mark.parametrize('jobs', [1, 3])
+    @pytest.mark.parametrize('read_order', H.READ_ORDERS)
+    def test_hashes_come_back_in_caller_order(self, tmpdir, jobs, read_order):
+        files, sizes = self._make_files(tmpdir, 12)
+        engine = H.HashEngine(jobs)
+        engine.read_order = read_order
+        try:
+            hashes = engine.hash_files(files, sizes)
+        finally:
+            engine.close()
+        assert hashes == [xxhash.xxh64(open(f, 'rb').read()).hexdigest() for f in files]
+        assert engine.bytes_hashed == sum(sizes)
+
+    def test_sort_key_falls_back_to_name(self, tmpdir):
+        engine = H.HashEngine()
+        engine.read_order = 'inode'
+        assert engine._sort_key(str(tmpdir.join('missing'))) == (2, str(tmpdir.join('missing')))
+
+    @pytest.mark.parametrize('read_order', ['inode', 'physical'])
+    def test_sort_key_uses_given_inode(self, tmpdir, read_order):
+        files, sizes = self._make_files(tmpdir, 3)
+        engine = H.HashEngine()
+        engine.read_order = read_order
+        with patch('os.stat') as stat, patch.object(engine, '_first_physical_offset') as fiemap:
+            for f, size in zip(files, sizes):
+                engine.submit(f, size, lambda _hash: None, ino=100 - size)
+        assert stat.call_count == fiemap.call_count == 0 # All small files
+        assert [batched[0] for batched in engine._next_batch()] == files[::-1]
+        engine.close()
+
+    def test_largest_file_goes_first_with_jobs(self, tmpdir):
+        files, sizes = self._make_files(tmpdir, 5)
+        engine = H.HashEngine(2)
+        try:
+            for f, size in zip(files, sizes):
+                engine.submit(f, size, lambda _hash: None)
+            assert engine.queued_bytes == sum(sizes)
+            assert engine._next_batch()[0][0] == files[-1]
+        finally:
+            engine.close()
+
+    def test_hardlinks_are_hashed_once(self, tmpdir):
+        files, sizes = self._make_files(tmpdir, 3)
+        link = str(tmpdir.join('link'))
+        os.link(files[2], link)
+        keys = [H.inode_key(os.stat(f)) for f in files + [link]]
+        assert keys[:2] == [None, None]
+        engine = H.HashEngine(2)
+        try:
+            hashes = engine.hash_files(files + [link], sizes + [sizes[2]], keys)
+            assert hashes[3] == hashes[2]
+            assert (engine.files_hashed, engine.files_reused) == (3, 1)
+            # Once it's in the cache, the file isn't queued at all
+            assert engine.hash_files([link], [sizes[2]], [keys[3]]) == [hashes[2]]
+            assert (engine.files_hashed, engine.files_reused) == (3, 2)
+        finally:
+            engine.close()
+
+    def test_digest_cache_evicts_least_recently_used(self):
+        cache = H.DigestCache(2)
+        cache.put('a', '1')
+        cache.put('b', '2')
+        cache.get('a')
+        cache.put('c', '3')
+        assert (cache.get('a'), cache.get('b'), cache.get('c'), len(cache)) == ('1', None, '3', 2)
+
+    @pytest.mark.parametrize('jobs', [1, 2])
+    def test_stalled_file_is_given_up_on(self, tmpdir, jobs):
+        files, sizes = self._make_files(tmpdir, 4)
+        hung = threading.Event()
+        real_get_hash = H.FileChecksum.get_hash
+        def get_hash(fc, filename, size=None):
+            if filename == files[1]:
+                hung.wait() # Like a read on a dead NFS mount
+            return real_get_hash(fc, filename, size)
+        engine = H.HashEngine(jobs)
+        engine.show_progress = False
+        engine.stall_timeout = 0.2
+        engine.fc.retries = 1
+        engine.fc.retry_backoff = 0.01
+        try:
+            with patch.object(H.FileChecksum, 'get_hash', autospec=True, side_effect=get_hash) as patched:
+                hashes = engine.hash_files(files, sizes)
+        finally:
+            hung.set()
+            engine.close()
+        assert hashes[1] is None
+        assert [h is not None for h in hashes] == [True, False, True, True]
+        assert engine.stalled == set([files[1]])
+        assert [c[0][1] for c in patched.call_args_list].count(files[1]) == 2 # Tried again once
+        assert engine.queued_files == 0 and engine.queued_bytes == 0
+
+    def test_retry_backoff_is_not_a_stall(self, tmpdir):
+        files, sizes = self._make_files(tmpdir, 2)
+        real_read_hash = H.FileChecksum._read_hash
+        failed = []
+        def read_hash(fc, filename, size):
+            if filename == files[0] and not failed:
+                failed.append(filename)
+                raise IOError(errno.EIO, 'Input/output error')
+            return real_read_hash(fc, filename, size)
+        engine = H.HashEngine()
+        engine.show_progress = False
+        engine.stall_timeout = 0.1
+        engine.fc.retry_backoff = 0.5
+        try:
+            with patch.object(H.FileChecksum, '_read_hash', autospec=True, side_effect=read_hash):
+                hashes = engine.hash_files(files, sizes)
+        finally:
+            engine.close()
+        assert failed and None not in hashes
+        assert engine.stalled == set()
+
+    def test_stalled_file_is_retried_after_a_long_backoff(self, tmpdir):
+        files, sizes = self._make_files(tmpdir, 2)
+        hung = threading.Event()
+        real_get_hash = H.FileChecksum.get_hash
+        calls = []
+        def get_hash(fc, filename, size=None):
+            calls.append(filename)
+            if calls.count(filename) == 1 and filename == files[1]:
+                hung.wait() # Only the first read hangs
+            return real_get_hash(fc, filename, size)
+        engine = H.HashEngine()
+        engine.show_progress = False
+        engine.stall_timeout = 0.2
+        engine.fc.retry_backoff = 0.5
+        try:
+            with patch.object(H.FileChecksum, 'get_hash', autospec=True, side_effect=get_hash):
+                hashes = engine.hash_files(files, sizes)
+        finally:
+            hung.set()
+            engine.close()
+        assert None not in hashes and engine.stalled == set()
+        assert calls.count(files[1]) == 2
@@ -0,0 +1,45 @@
+import verifytree.hash_xattrs as X
+import verifytree.check_dirs as C
+import pytest
+import os
+
+from mock import patch
+
+
+@pytest.fixture
+def xattrs(tmpdir):
+    x = X.HashXattrs()
+    probe = tmpdir.join('probe')
+    probe.write('')
+    x.set(str(probe), os.stat(str(probe)), 'abc')
+    if not x.enabled or x.get(str(probe), os.stat(str(probe))) != 'abc':
+        pytest.skip('No user xattrs here')
+    probe.remove()
+    return X.HashXattrs()
+
+
+class TestHashXattrs:
+
+    def test_stale_hash_is_ignored(self, tmpdir, xattrs):
+        f = tmpdir.join('f')
+        f.write('a')
+        xattrs.set(str(f), os.stat(str(f)), '1234')
+        assert xattrs.get(str(f), os.stat(str(f))) == '1234'
+        f.write('ab')
+        assert xattrs.get(str(f), os.stat(str(f))) is None
+        assert xattrs.reused == 1
+
+    def test_renamed_file_is_not_rehashed(self, tmpdir, xattrs):
+        tmpdir.join('f1').write('a'*10)
+        c = C.CheckDirs()
+        c.quiet = True
+        c.update_hash_files = True
+        c.xattrs = xattrs
+        list(c.iter_validate(str(tmpdir)))
+
+        tmpdir.join('f1').rename(tmpdir.join('f2'))
+        with patch.object(c.engine.fc, 'get_hash') as get_hash:
+            results = list(c.iter_validate(str(tmpdir)))
+        assert get_hash.call_count == 0
+        assert (results[0].results.files_new, results[0].results.files_deleted) == (1, 1)
+        assert xattrs.reused == 1
@@ -0,0 +1,54 @@
+import verifytree.metrics as M
+import verifytree.check_dirs as C
+import pytest
+import os
+import urllib2
+
+
+class TestMetrics:
+
+    def setup(self):
+        self.c = C.CheckDirs()
+        self.c.quiet = True
+        self.m = M.Metrics(self.c.engine)
+        self.c.metrics = self.m
+        self.c.engine.metrics = self.m
+        self.c.listener = self.m.observe_finding
+
+    def _run(self, tmpdir):
+        tmpdir.join('f1').write('a'*10)
+        tmpdir.mkdir('sub').join('f2').write('b'*20)
+        self.c.scan(str(tmpdir))
+        for result in self.c.iter_validate(str(tmpdir)):
+            pass
+
+    def test_render(self, tmpdir):
+        self._run(tmpdir)
+        text = self.m.render()
+        assert 'verifytree_bytes_hashed_total 30\n' in text
+        assert 'verifytree_files_hashed_total 2\n' in text
+        assert 'verifytree_dirs_done_total 2\n' in text
+        assert 'verifytree_findings_total{kind="files_new"} 2\n' in text
+        assert 'verifytree_phase_seconds_bucket{phase="hash",le="+Inf"} 2\n' in text
+        assert 'verifytree_phase_seconds_count{phase="scan"} 2\n' in text
+        assert 'verifytree_queue_files 0\n' in text
+
+    def test_histogram_buckets_are_cumulative(self):
+        self.m.observe('commit', 0.002)
+        self.m.observe('commit', 7)
+        text = self.m.render()
+        assert 'verifytree_phase_seconds_bucket{phase="commit",le="0.001"} 0\n' in text
+        assert 'verifytree_phase_seconds_bucket{phase="commit",le="0.005"} 1\n' in text
+        assert 'verifytree_phase_seconds_bucket{phase="commit",le="300"} 2\n' in text
+
+    def test_textfile_and_http(self, tmpdir):
+        prom = str(tmpdir.join('verifytree.prom'))
+        self.m.start(textfile=prom, port=0, interval=60)
+        try:
+            port = self.m._server.server_address[1]
+            text = urllib2.urlopen('http://127.0.0.1:%d/metrics' % port).read()
+            assert 'verifytree_running 1\n' in text
+        finally:
+            self.m.close()
+        assert 'verifytree_running 0\n' in open(prom).read()
+        assert os.listdir(str(tmpdir)) == ['verifytree.prom']
@@ -0,0 +1,94 @@
+import verifytree.path_filter as P
+import verifytree.check_dirs as C
+from verifytree.checksum_store import ChecksumStore
+import pytest
+import os
+import time
+import yaml
+
+from mock import patch
+
+
+class TestPathFilter:
+
+    @pytest.mark.parametrize('rules, path, is_dir, excluded', [
+        (['*.tmp'], 'a.tmp', False, True),
+        (['*.tmp'], 'x/y/a.tmp', False, True),
+        (['*.tmp'], 'a.tmpx', False, False),
+        (['cache/'], 'x/cache', True, True),
+        (['cache/'], 'x/cache', False, False),
+        (['/scratch'], 'scratch', True, True),
+        (['/scratch'], 'x/scratch', True, False),
+        (['a/*.log'], 'a/b.log', False, True),
+        (['a/*.log'], 'a/b/c.log', False, False),
+        (['a/**/c.log'], 'a/b/d/c.log', False, True),
+        (['a/**/c.log'], 'a/c.log', False, True),
+        (['**/.snapshot'], 'x/.snapshot', True, True),
+        (['build/**'], 'build/x/y', False, True),
+        (['*.log', '!keep.log'], 'keep.log', False, False),
+        (['!keep.log', '*.log'], 'keep.log', False, True),
+        (['file[0-9].txt'], 'file3.txt', False, True),
+        (['file[!0-9].txt'], 'file3.txt', False, False),
+        (['# comment', '', '\\#hash'], '#hash', False, True),
+    ])
+    def test_rules(self, rules, path, is_dir, excluded):
+        assert P.PathFilter(rules).excluded(path, is_dir) == excluded
+
+    def test_many_rules(self):
+        f = P.PathFilter(['f%d' % i for i in range(250)] + ['!f7'])
+        assert f.excluded('x/f249') and f.excluded('f0') and not f.excluded('f7')
+
+    def test_excluded_path_checks_parents(self):
+        f = P.PathFilter(['cache/'])
+        assert f.excluded_path('a/cache/b/c')
+        assert not f.excluded_path('a/b/cache')
+
+    def test_size_and_age(self, tmpdir):
+        tmpdir.join('small').write('a')
+        tmpdir.join('big').write('a'*100)
+        tmpdir.join('old').write('a'*50)
+        os.utime(str(tmpdir.join('old')), (time.time()-3600, time.time()-3600))
+        f = P.PathFilter(min_size=10, min_age=60)
+        assert f.filter_listing('.', [], ['small', 'big', 'old'], str(tmpdir)) == ([], ['old'])
+        assert f.signature and not P.same_filter(f, {'filter': f.signature})
+
+    def test_pruned_dirs_are_not_listed(self, tmpdir):
+        tmpdir.join('f1').write('a')
+        tmpdir.join('f1.tmp').write('b')
+        tmpdir.mkdir('cache').join('x').write('c')
+        c = C.CheckDirs()
+        c.quiet = True
+        c.path_filter = P.PathFilter(['cache/', '*.tmp'])
+        with patch('os.listdir', wraps=os.listdir) as listdir:
+            assert c.scan(str(tmpdir)) == (1, 1, 1)
+            results = list(c.iter_validate(str(tmpdir)))
+        assert str(tmpdir.join('cache')) not in [args[0] for args, kw in listdir.call_args_list]
+        assert results[0].results.files_new == 1
+
+    def test_excluded_entries_are_kept(self, tmpdir):
+        tmpdir.join('f1').write('a')
+        tmpdir.join('f1.tmp').write('b')
+        tmpdir.join('old').write('c')
+        tmpdir.mkdir('cache').join('x').write('d')
+        for f in ('f1', 'f1.tmp', 'old'):
+            os.utime(str(tmpdir.join(f)), (1e9, 1e9)) # Saved mtimes only compare to the second
+        c = C.CheckDirs()
+        c.quiet = True
+        c.update_hash_files = True
+        list(c.iter_validate(str(tmpdir)))
+        checksum_file = str(tmpdir.join(c.dbname))
+        with open(checksum_file) as f:
+            saved = f.read()
+
+        os.utime(str(tmpdir.join('f1')), (time.time(), time.time()))
+        c.path_filter = P.PathFilter(['cache/', '*.tmp'], max_age=30)
+        findings = []
+        c.listener = findings.append
+        results = list(c.iter_validate(str(tmpdir)))
+        assert [(f.kind, os.path.basename(f.path)) for f in findings] == [('files_changed', 'f1')]
+        assert results[0].results.files_deleted == results[0].results.dirs_missing == 0
+
+        hashes = ChecksumStore().load(checksum_file)
+        assert sorted(hashes['files']) == ['f1', 'f1.tmp', 'old']
+        assert hashes['dirs'] == ['cache']
+        assert hashes['files']['old'] == yaml.load(saved)['files']['old']
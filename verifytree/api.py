@@ -0,0 +1,164 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Library interface for running a validation from other Python code
+
+    Nothing gets printed; instead the findings are handed back lazily as the
+    tree gets validated::
+
+        from verifytree.api import verify_tree
+
+        run = verify_tree('/archive', jobs=4, update=True)
+        for finding in run:
+            if finding.kind == 'files_chksum_error':
+                alert(finding.path)
+        print(run.results)
+
+    Call ``run.cancel()`` from another thread to stop early, and read
+    ``run.progress`` at any time to see how far along it is.
+"""
+import threading
+import check_dirs
+from hash_engine import HashEngine
+from hash_xattrs import HashXattrs
+from dir_checksum import Finding, Results
+from exceptions import *
+
+
+class Progress(object):
+    """
+        Snapshot of how far along a run is.  The totals come from the initial
+        scan; bytes_done counts bytes that have actually been hashed.
+    """
+
+    def __init__(self, dirs_total=0, files_total=0, bytes_total=0,
+                 dirs_done=0, files_done=0, bytes_done=0):
+        self.dirs_total = dirs_total
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.dirs_done = dirs_done
+        self.files_done = files_done
+        self.bytes_done = bytes_done
+
+    def __repr__(self):
+        return 'Progress(dirs %d/%d, files %d/%d, bytes %d/%d)' % (
+            self.dirs_done, self.dirs_total, self.files_done, self.files_total,
+            self.bytes_done, self.bytes_total)
+
+
+class TreeVerifier(object):
+    """
+        Iterate over this to run the validation and get each
+        :class:`verifytree.dir_checksum.Finding`.  The findings for a directory
+        are yielded once that directory is done.  With more than one job, later
+        directories are already being hashed by then, so a finding may be
+        reported a little before its directory's turn.
+    """
+
+    def __init__(self, path, jobs=1, store=None, update=False, force=False,
+                 freshen=False, fast_scan=False, cancel=None, io_mode='buffered',
+                 path_filter=None, xattrs=False, detect_moves=False, archives=False, stall_timeout=None):
+        self.path = path
+        self.store = store
+        self.results = Results()
+        self.cancelled = False
+        if cancel is None:
+            cancel = threading.Event()
+        self._cancel = cancel
+
+        self.checker = check_dirs.CheckDirs()
+        self.checker.quiet = True
+        self.checker.update_hash_files = update or force
+        self.checker.force_update_hash_files = force
+        self.checker.freshen_hash_files = freshen
+        self.checker.fast_scan = fast_scan
+        self.checker.path_filter = path_filter
+        if xattrs:
+            self.checker.xattrs = HashXattrs()
+        self.checker.detect_moves = detect_moves
+        self.checker.archives = archives
+        self.checker.engine = HashEngine(jobs)
+        self.checker.engine.show_progress = False
+        self.checker.engine.fc.io_mode = io_mode
+        self.checker.engine.cancel_event = self._cancel
+        self.checker.engine.stall_timeout = stall_timeout
+        if jobs > 1:
+            self.checker.lookahead_bytes = 16*2**30
+        self._scanned = (0, 0, 0)
+        self._dirs_done = 0
+        self._started = False
+
+    def cancel(self):
+        """
+            Stop the run.  Directories already done keep their updates, the one
+            in progress is left as it was.
+        """
+        self._cancel.set()
+
+    @property
+    def progress(self):
+        n_dirs, n_files, sz_files = self._scanned
+        return Progress(n_dirs, n_files, sz_files,
+                        self._dirs_done, self.results.files_total,
+                        self.checker.engine.bytes_hashed)
+
+    def __iter__(self):
+        if self._started:
+            raise RuntimeError('A TreeVerifier can only be run once')
+        self._started = True
+
+        findings = []
+        self.checker.listener = findings.append
+        self._scanned = self.checker.scan(self.path)
+        try:
+            for result in self.checker.iter_validate(self.path, self.store):
+                self.results += result.results
+                self._dirs_done += 1
+                for finding in findings:
+                    yield finding
+                del findings[:]
+                if self._cancel.is_set():
+                    raise VerificationCancelled('Cancelled after %s' % result.path)
+        except VerificationCancelled:
+            self.cancelled = True
+
+
+def verify_tree(path, jobs=1, store=None, update=False, force=False,
+                freshen=False, fast_scan=False, cancel=None, io_mode='buffered',
+                path_filter=None, xattrs=False, detect_moves=False, archives=False, stall_timeout=None):
+    """
+        Validate (or create) the checksum files for a directory tree
+
+        :param path: Top of the tree
+        :param jobs: Number of threads to hash files with
+        :param store: :class:`verifytree.checksum_store.ChecksumStore` to read and write the checksum files with
+        :param update: Update the checksum files for new, deleted and changed files (like -u)
+        :param force: Also accept new hashes for files with checksum or size errors (like -f)
+        :param freshen: Only hash files that don't have a hash yet
+        :param fast_scan: Reuse the saved listing of directories that haven't changed
+        :param cancel: Optional threading.Event that stops the run when set
+        :param io_mode: One of verifytree.file_checksum.IO_MODES; use 'nocache' or 'direct' to keep the run out of the page cache
+        :param path_filter: Optional :class:`verifytree.path_filter.PathFilter` of files and directories to skip
+        :param detect_moves: Report files moved within the tree as moved (files_moved) and keep their hash instead of reading them again
+        :param archives: Also hash each member of tar and zip archives, and report damaged members by their path inside the archive
+        :param stall_timeout: Seconds a file read can make no progress before it's given up on and counted in files_stalled (None to wait forever)
+        :param xattrs: Keep a copy of each hash in the file's extended attributes, and reuse it for files that were moved or renamed
+        :returns: A :class:`TreeVerifier` to iterate over for the findings
+        :rtype: TreeVerifier
+    """
+    return TreeVerifier(path, jobs=jobs, store=store, update=update, force=force,
+                        freshen=freshen, fast_scan=fast_scan, cancel=cancel, io_mode=io_mode,
+                        path_filter=path_filter, xattrs=xattrs, detect_moves=detect_moves,
+                        archives=archives, stall_timeout=stall_timeout)
@@ -0,0 +1,185 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Class to hash the members of tar and zip archives
+
+    Each member is streamed straight out of the archive into its own
+    hasher, so nothing gets extracted to disk.  The archive is read front
+    to back once, in the same chunks (and with the same io_mode and read
+    ahead) as FileChecksum reads any other file, and the hash of the whole
+    archive is worked out from those same chunks.  So it comes out the same
+    as FileChecksum.get_hash gives, and turning this on or off doesn't make
+    existing checksums look wrong.  The only other reads are of a zip
+    file's central directory at the end, which is small.
+
+    An archive that turns out to be corrupt or not an archive at all still
+    gets its whole-file hash, just without any members.  Zip members that
+    can't be read without a password, or use a compression method Python
+    doesn't have (like 7-Zip's bzip2 or LZMA), are left out of the members.
+"""
+import os, tarfile, zipfile, zlib, logging
+import xxhash
+
+
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz', '.tbz2', '.zip')
+
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+class _ChunkReader(object):
+    """
+        Read-only file object over the chunks FileChecksum reads a file in,
+        hashing each chunk as it goes past.  Seeking forward skips ahead
+        through the chunks; the odd read from further back goes to the file
+        itself.
+    """
+
+    def __init__(self, fc, filename, filesize):
+        self.fc = fc
+        self.filename = filename
+        self.size = filesize
+        self.chunks = fc.iter_chunks(filename, filesize)
+        self.hasher = xxhash.xxh64()
+        self.pos = 0
+        self._buf = ''      # The current chunk
+        self._buf_pos = 0   # Where the current chunk starts in the file
+        self._side = None   # Plain file for reads from before the current chunk
+
+    def _next_chunk(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.hasher.update(chunk)
+        if self.fc.on_progress is not None:
+            self.fc.on_progress()
+        self._buf_pos += len(self._buf)
+        self._buf = str(chunk) # Copied, as the chunk's buffer gets reused
+        return True
+
+    def read(self, size=-1):
+        if self.pos < self._buf_pos:
+            if self._side is None:
+                self._side = open(self.filename, 'rb')
+            self._side.seek(self.pos)
+            data = self._side.read(size)
+            self.pos += len(data)
+            return data
+        data = []
+        while size != 0:
+            offset = self.pos - self._buf_pos
+            if offset >= len(self._buf):
+                if not self._next_chunk():
+                    break
+                continue
+            part = self._buf[offset:] if size < 0 else self._buf[offset:offset+size]
+            data.append(part)
+            self.pos += len(part)
+            if size > 0:
+                size -= len(part)
+        return ''.join(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def hexdigest(self):
+        # Whatever the archive reader skipped over or didn't need still has to be hashed
+        while self._next_chunk():
+            pass
+        return self.hasher.hexdigest()
+
+    def close(self):
+        self.chunks.close()
+        if self._side is not None:
+            self._side.close()
+
+
+class ArchiveChecksum(object):
+
+    def __init__(self, fc):
+        self.fc = fc # FileChecksum to read the archive with
+
+    def get_hash(self, filename, filesize=None):
+        """
+            Returns (hash of the whole archive, members) where members is a
+            dict of member name -> {'size', 'hash'}, or None if the archive
+            couldn't be read at all.  members is None if the file couldn't be
+            read as an archive.  Read errors are retried like any other file's.
+        """
+        return self.fc.with_retries(filename, lambda: self._read_hash(filename, filesize))
+
+    def _read_hash(self, filename, filesize):
+        if filesize is None:
+            filesize = os.stat(filename).st_size
+        reader = _ChunkReader(self.fc, filename, filesize)
+        try:
+            try:
+                members = self._get_members(filename, reader)
+            except (tarfile.TarError, zipfile.BadZipfile, zlib.error, EOFError) as e:
+                logging.debug("Could not read %s as an archive: %s" % (filename, e))
+                members = None
+            return reader.hexdigest(), members
+        finally:
+            reader.close()
+
+    def _get_members(self, filename, reader):
+        if filename.lower().endswith('.zip'):
+            return self._get_zip_members(filename, reader)
+        return self._get_tar_members(reader)
+
+    def _get_tar_members(self, reader):
+        members = {}
+        # Stream mode never seeks backwards, so the archive only gets read once
+        tar = tarfile.open(fileobj=reader, mode='r|*', bufsize=self.fc.blocksize)
+        for member in tar:
+            if member.isfile():
+                members[member.name] = self._hash_member(tar.extractfile(member), member.size)
+        tar.close()
+        return members
+
+    def _get_zip_members(self, filename, reader):
+        members = {}
+        with open(filename, 'rb') as f:
+            archive = zipfile.ZipFile(f)
+            # The central directory came from the end of the file; the members come off the chunks
+            archive.fp = reader
+            # In the order they are stored, so the reads carry on from each other
+            for info in sorted(archive.infolist(), key=lambda info: info.header_offset):
+                if info.filename.endswith('/'):
+                    continue
+                try:
+                    members[info.filename] = self._hash_member(archive.open(info), info.file_size)
+                except (RuntimeError, NotImplementedError) as e:
+                    # Encrypted, or compressed in a way zipfile can't read
+                    logging.debug("Skipping member %s of %s: %s" % (info.filename, filename, e))
+            archive.fp = f
+            archive.close()
+        return members
+
+    def _hash_member(self, f, size):
+        hasher = xxhash.xxh64()
+        buf = f.read(self.fc.blocksize)
+        while buf:
+            hasher.update(buf)
+            buf = f.read(self.fc.blocksize)
+        return {'size': size, 'hash': hasher.hexdigest()}
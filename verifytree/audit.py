@@ -0,0 +1,260 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Class to estimate the health of a tree from a random sample of its files
+
+    Instead of hashing everything, a random sample of the files recorded in
+    the checksum files is hashed, and the share of them that fail is given
+    along with a Wilson score confidence interval for the whole tree.  The
+    tree is only read through its checksum files (following the 'dirs' each
+    one lists), so nothing has to be listed.
+
+    The sample is either uniform over files, or weighted by size (so the
+    rate is the share of the data that's damaged rather than of the files).
+    Either way it's drawn in one pass without holding every record in
+    memory.  A uniform sample keeps the files with the highest random keys
+    (Efraimidis-Spirakis reservoir sampling).  A sample by size is n
+    independent draws with replacement, each picking a file in proportion
+    to its size, so a big file can come up more than once and counts each
+    time.  Drawing without replacement would tilt the rate towards the
+    small files once the big ones have been picked.
+
+    Files that were modified since they were recorded, or have gone, can't
+    say anything about corruption, so they are counted but left out of the
+    rate.
+"""
+import os, math, heapq, random, itertools, collections, logging
+from checksum_store import ChecksumStore
+
+
+Z_SCORES = {90: 1.6449, 95: 1.9600, 99: 2.5758} # Confidence level (%) -> two-sided normal quantile
+
+
+def wilson_interval(failures, n, z=Z_SCORES[95]):
+    """
+        Returns the (low, high) Wilson score interval for the failure rate
+        after seeing failures out of n
+    """
+    if n == 0:
+        return 0.0, 1.0
+    p = float(failures) / n
+    denominator = 1 + z*z / n
+    centre = (p + z*z / (2*n)) / denominator
+    half_width = z * math.sqrt(p*(1 - p) / n + z*z / (4*n*n)) / denominator
+    return max(0.0, centre - half_width), min(1.0, centre + half_width)
+
+
+class Reservoir(object):
+    """
+        Random sample of up to n items from a stream, without replacement,
+        each item picked with a chance in proportion to its weight
+    """
+
+    def __init__(self, n, rng=None):
+        self.n = n
+        self.rng = rng or random.Random()
+        self._heap = [] # (key, seq, item) for the n highest keys so far
+        self._seq = itertools.count()
+
+    def add(self, item, weight=1):
+        if weight <= 0 or self.n <= 0:
+            return
+        # log(u)/w orders the same as u**(1/w), without running out of precision for big weights
+        key = math.log(1.0 - self.rng.random()) / weight
+        if len(self._heap) < self.n:
+            heapq.heappush(self._heap, (key, next(self._seq), item))
+        elif key > self._heap[0][0]:
+            heapq.heapreplace(self._heap, (key, next(self._seq), item))
+
+    @property
+    def items(self):
+        return [item for key, seq, item in self._heap]
+
+
+class WeightedDraws(object):
+    """
+        n independent draws with replacement from a stream, each picking an
+        item with a chance in proportion to its weight.  Each draw is its
+        own reservoir of one, which a new item takes over with a chance of
+        its weight over the total so far.
+    """
+
+    def __init__(self, n, rng=None):
+        self.n = n
+        self.rng = rng or random.Random()
+        self.total = 0
+        self._picks = [None] * n
+
+    def add(self, item, weight=1):
+        if weight <= 0 or self.n <= 0:
+            return
+        self.total += weight
+        for i in self._draws_taken(float(weight) / self.total):
+            self._picks[i] = item
+
+    def _draws_taken(self, p):
+        """
+            Returns the draws the new item takes over, each with chance p.
+            The gaps between them are geometric, so there's no need for a
+            random number per draw.
+        """
+        if p >= 1:
+            return range(self.n)
+        taken = []
+        i = -1
+        log_q = math.log1p(-p)
+        while True:
+            i += 1 + int(math.log(1.0 - self.rng.random()) / log_q)
+            if i >= self.n:
+                return taken
+            taken.append(i)
+
+    @property
+    def items(self):
+        return [item for item in self._picks if item is not None]
+
+
+class AuditResults(object):
+
+    def __init__(self):
+        self.population_files = 0   # Files with a hash in the checksum files
+        self.population_bytes = 0
+        self.sampled = 0            # Draws, which can repeat a file when by size
+        self.validated = 0
+        self.chksum_error = 0
+        self.unreadable = 0
+        self.changed = 0            # Modified since they were recorded, so left out of the rate
+        self.missing = 0            # Gone since they were recorded, so left out of the rate
+        self.by_size = False
+        self.confidence = 95
+        self.failed = []            # (path, kind) of every file that failed, once each
+
+    @property
+    def checked(self):
+        return self.validated + self.failures
+
+    @property
+    def failures(self):
+        return self.chksum_error + self.unreadable
+
+    @property
+    def rate(self):
+        return float(self.failures) / self.checked if self.checked else 0.0
+
+    @property
+    def interval(self):
+        return wilson_interval(self.failures, self.checked, Z_SCORES[self.confidence])
+
+    def __str__(self):
+        low, high = self.interval
+        return '\n'.join([
+            ("Drew %d times by size from %d files (%.2fGB)" if self.by_size else "Sampled %d of %d files (%.2fGB)")
+                % (self.sampled, self.population_files, float(self.population_bytes)/2**30),
+            "Validated: %d, checksum errors: %d, unreadable: %d, changed since recorded: %d, missing: %d"
+                % (self.validated, self.chksum_error, self.unreadable, self.changed, self.missing),
+            "Failure rate%s: %.3f%% (%d%% confidence interval %.3f%% - %.3f%%)"
+                % (" (by size)" if self.by_size else "", 100*self.rate, self.confidence, 100*low, 100*high),
+        ])
+
+
+class Audit(object):
+
+    def __init__(self, engine, dbname='.verifytree_checksum', store=None):
+        self.engine = engine
+        self.dbname = dbname
+        self.store = store or ChecksumStore()
+        self.path_filter = None # path_filter.PathFilter of files and directories to leave out
+
+    def records(self, path):
+        """
+            Yields (full path, entry) for every file with a hash in the
+            checksum files under path.  path_filter's size and age limits go
+            by the saved size and mtime.
+        """
+        to_visit = ['.']
+        while to_visit:
+            rel_dir = to_visit.pop()
+            root = os.path.normpath(os.path.join(path, rel_dir))
+            checksum_file = os.path.join(root, self.dbname)
+            try:
+                hashes = self.store.load(checksum_file)
+            except IOError as e:
+                logging.warning("Skipping %s, which has no checksum file" % root)
+                continue
+            prefix = '' if rel_dir == '.' else os.path.relpath(root, path).replace(os.sep, '/') + '/'
+            for name, entry in sorted(hashes['files'].items()):
+                if not entry.get('hash'):
+                    continue
+                if self.path_filter is not None and (self.path_filter.excluded_path(prefix + name)
+                        or self.path_filter.excluded_size(long(entry['size']), entry['mtime'])):
+                    continue
+                yield os.path.join(root, name), entry
+            for d in hashes.get('dirs', []):
+                # Symlinks to directories are listed, but not followed, like in the walk
+                if os.path.islink(os.path.join(root, d)):
+                    continue
+                if self.path_filter is None or not self.path_filter.excluded(prefix + d, is_dir=True):
+                    to_visit.append(os.path.join(rel_dir, d))
+
+    def audit(self, path, n, by_size=False, confidence=95, seed=None):
+        """
+            Hash a random sample of n of the files recorded under path
+
+            :param by_size: Draw files n times in proportion to their size instead of uniformly
+            :param confidence: Confidence level (%) for the interval, one of Z_SCORES
+            :param seed: Seed for the random sample, to draw the same one again
+            :rtype: AuditResults
+        """
+        results = AuditResults()
+        results.by_size = by_size
+        results.confidence = confidence
+        rng = random.Random(seed)
+        sample = WeightedDraws(n, rng) if by_size else Reservoir(n, rng)
+        for filename, entry in self.records(path):
+            size = long(entry['size'])
+            results.population_files += 1
+            results.population_bytes += size
+            # Empty files still get a look in when weighting by size
+            sample.add((filename, entry), max(size, 1) if by_size else 1)
+
+        # Each file is only checked once, but counts for every draw of it
+        draws = collections.Counter(filename for filename, entry in sample.items)
+        entries = dict(sample.items)
+        to_hash = []
+        for filename in sorted(draws):
+            entry = entries[filename]
+            results.sampled += draws[filename]
+            try:
+                fstat = os.stat(filename)
+            except OSError:
+                results.missing += draws[filename]
+                continue
+            if int(fstat.st_mtime) != int(entry['mtime']) or fstat.st_size != long(entry['size']):
+                results.changed += draws[filename]
+                continue
+            to_hash.append((filename, entry, fstat))
+
+        _hashes = self.engine.hash_files([f for f, e, st in to_hash], [st.st_size for f, e, st in to_hash],
+                                         inos=[st.st_ino for f, e, st in to_hash])
+        for (filename, entry, fstat), _hash in zip(to_hash, _hashes):
+            if _hash is None:
+                results.unreadable += draws[filename]
+                results.failed.append((filename, 'unreadable'))
+            elif _hash != entry['hash']:
+                results.chksum_error += draws[filename]
+                results.failed.append((filename, 'chksum_error'))
+            else:
+                results.validated += draws[filename]
+        return results
@@ -0,0 +1,157 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Class to pick the fastest block size for each device (-b auto)
+
+    The first few large files hashed on each device (st_dev) are read with
+    each of the candidate block sizes in turn, and once every candidate has
+    had its share, the one with the best throughput is kept for the rest of
+    the run.  The choice is saved in a tuning file, so later runs start with
+    it straight away.  Delete an entry (or the whole file) to tune again,
+    e.g. after the storage behind a mount changes.
+
+    st_dev numbers can be handed out differently after a reboot or remount
+    (and always are for NFS and FUSE), so the tuning file is keyed by the
+    mount point and filesystem type from /proc/self/mountinfo instead.
+    Devices that can't be found there are tuned afresh on every run.
+
+    Files smaller than MIN_TRIAL_SIZE are too quick to time, so they just
+    use the default block size until the device has been tuned.
+"""
+import os, re, threading, logging
+import yaml
+
+
+MOUNTINFO = '/proc/self/mountinfo'
+CANDIDATES = (65536, 262144, 1048576, 4194304)
+TRIALS = 3                  # Files to time with each candidate
+MIN_TRIAL_SIZE = 4*2**20    # Smallest file worth timing
+
+
+def mount_key(dev, mountinfo=MOUNTINFO):
+    """
+        Returns "<mount point> (<fs type>)" for the filesystem with st_dev dev,
+        or None if it isn't in mountinfo
+    """
+    majmin = '%d:%d' % (os.major(dev), os.minor(dev))
+    try:
+        with open(mountinfo) as f:
+            lines = f.readlines()
+    except IOError:
+        return None
+    mounts = []
+    for line in lines:
+        # id parent major:minor root mount-point options [optional...] - fstype source super-options
+        fields = line.split()
+        if len(fields) < 7 or fields[2] != majmin or '-' not in fields[6:]:
+            continue
+        fstype = fields[fields.index('-', 6) + 1]
+        mount_point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[4])
+        # Bind mounts share the device; prefer the mount of its whole filesystem
+        mounts.append((fields[3] != '/', len(mount_point), mount_point, fstype))
+    if not mounts:
+        return None
+    _, _, mount_point, fstype = min(mounts)
+    return '%s (%s)' % (mount_point, fstype)
+
+
+class BlockTuner(object):
+
+    def __init__(self, tuning_file=None, default=1048576, candidates=CANDIDATES):
+        """
+            :param tuning_file: Where the block size chosen for each device is kept (None to not keep it)
+            :param default: Block size to use on devices that haven't been tuned yet
+        """
+        self.tuning_file = tuning_file
+        self.default = default
+        self.candidates = candidates
+        self.tuned = {}            # st_dev -> block size for this run
+        self._saved = self._load() # mount_key -> block size from the tuning file
+        self._mounts = {}          # st_dev -> mount_key (None if unknown)
+        self._started = {}         # st_dev -> {block size: files handed out}
+        self._timings = {}         # st_dev -> {block size: [files, bytes, seconds]}
+        self._lock = threading.Lock() # Called from the hashing threads
+
+    def blocksize(self, dev, size):
+        """
+            Returns the block size to read a file of size bytes on device dev with
+        """
+        with self._lock:
+            if dev not in self.tuned and self._mount(dev) in self._saved:
+                self.tuned[dev] = self._saved[self._mount(dev)]
+            if dev in self.tuned:
+                return self.tuned[dev]
+            if size < MIN_TRIAL_SIZE:
+                return self.default
+            started = self._started.setdefault(dev, dict((b, 0) for b in self.candidates))
+            blocksize = min(self.candidates, key=lambda b: started[b])
+            started[blocksize] += 1
+            return blocksize
+
+    def record(self, dev, blocksize, size, seconds):
+        """
+            Note how long a file took to hash, and pick the block size for the
+            device once every candidate has been timed enough
+        """
+        with self._lock:
+            if dev in self.tuned or size < MIN_TRIAL_SIZE or blocksize not in self.candidates:
+                return
+            timings = self._timings.setdefault(dev, dict((b, [0, 0, 0.0]) for b in self.candidates))
+            timing = timings[blocksize]
+            timing[0] += 1
+            timing[1] += size
+            timing[2] += seconds
+            if any(files < TRIALS for files, nbytes, secs in timings.values()):
+                return
+            best = max(self.candidates, key=lambda b: timings[b][1] / max(timings[b][2], 1e-9))
+            logging.info("Using a block size of %d on device %d, %s (%s)" % (best, dev, self._mount(dev), ', '.join(
+                '%d: %.1fMB/s' % (b, timings[b][1] / max(timings[b][2], 1e-9) / 2**20) for b in self.candidates)))
+            self.tuned[dev] = best
+            del self._started[dev]
+            del self._timings[dev]
+            self._save(dev, best)
+
+    def _load(self):
+        if self.tuning_file is None or not os.path.exists(self.tuning_file):
+            return {}
+        try:
+            with open(self.tuning_file) as f:
+                tuned = yaml.safe_load(f) or {}
+            return dict((str(mount), int(blocksize)) for mount, blocksize in tuned.get('mounts', {}).items())
+        except (IOError, yaml.YAMLError, AttributeError, ValueError) as e:
+            logging.warning("Ignoring tuning file %s: %s" % (self.tuning_file, e))
+            return {}
+
+    def _mount(self, dev):
+        if dev not in self._mounts:
+            self._mounts[dev] = mount_key(dev)
+        return self._mounts[dev]
+
+    def _save(self, dev, blocksize):
+        """
+            Add the device's mount to the tuning file, keeping whatever another
+            run may have added to it since it was loaded
+        """
+        if self.tuning_file is None or self._mount(dev) is None:
+            return
+        saved = self._load()
+        saved[self._mount(dev)] = blocksize
+        tmp_file = '%s.tmp.%d' % (self.tuning_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write(yaml.safe_dump({'mounts': saved}, default_flow_style=False))
+            os.rename(tmp_file, self.tuning_file)
+        except (IOError, OSError) as e:
+            logging.warning("Could not save tuning file %s: %s" % (self.tuning_file, e))
@@ -14,8 +14,14 @@
 
 
 from __future__ import print_function
-import os, logging
+import os, logging, collections, time
 import dir_checksum
+from checksum_store import ChecksumStore
+from hash_engine import HashEngine
+from utils import get_dir_stat, same_dir_stat
+from path_filter import same_filter
+from move_tracker import MoveTracker
+from exceptions import DirectoryMissing
 
 class CheckDirs(object):
 
@@ -24,33 +30,200 @@ class CheckDirs(object):
         self.force_update_hash_files = False # Force on checksum error to new hash (only do this if you're sure this wasn't a bit-rot or file corruption!)
         self.freshen_hash_files = False
         self.dbname = '.verifytree_checksum'
+        self.fsync_batch = 1 # Number of checksum files to write before fsync'ing them together
+        self.fast_scan = False # Trust the saved listing of directories whose mtime hasn't changed
+        self.engine = HashEngine() # Shared by all the directories
+        self.quiet = False
+        self.listener = None # Called with every dir_checksum.Finding
+        self.lookahead_bytes = 0 # Keep starting directories until this much is queued on the engine
+        self.lookahead_dirs = 1000
+        self.metrics = None # Optional metrics.Metrics to record each phase in
+        self.path_filter = None # Optional path_filter.PathFilter of files and directories to skip
+        self.xattrs = None # Optional hash_xattrs.HashXattrs to keep hashes in and reuse them from
+        self.detect_moves = False # Match up missing and new files across the whole tree
+        self.archives = False # Also hash each member of tar and zip archives
+        self.work = None
 
+    def validate_single_directory(self, path, store=None):
+        if store is None:
+            # Stand-alone directory, so flush its checksum file right away
+            store = ChecksumStore(keep_dir_mtime=self.fast_scan)
+            try:
+                dc = self.validate_single_directory(path, store)
+            finally:
+                store.close()
+                self.engine.close()
+            return dc
+        dc = self._dir_checksum(path, store)
+        dc.validate()
+        return dc
 
-    def validate_single_directory(self, path):
-        dc = dir_checksum.DirChecksum(path, self.dbname, self.work)
+    def _dir_checksum(self, path, store, rel_dir='.'):
+        dc = dir_checksum.DirChecksum(path, self.dbname, self.work, store, self.engine)
         dc.update_hash_files = self.update_hash_files
         dc.force_update_hash_files = self.force_update_hash_files
         dc.freshen_hash_files = self.freshen_hash_files
-        dc.validate()
+        dc.fast_scan = self.fast_scan
+        dc.quiet = self.quiet
+        dc.listener = self.listener
+        dc.path_filter = self.path_filter
+        dc.xattrs = self.xattrs
+        dc.archives = self.archives
+        dc.rel_dir = rel_dir
         return dc
 
-    def validate(self, path):
+    def validate(self, path, filenames=None):
         total = dir_checksum.Results()
-        total.dirs_total += 1  # Account for this starting directory
-        for root, subdirs, files in os.walk(path):
-            result = self.validate_single_directory(root)
-
-            # Make a sanity check of the total files processed by making sure
-            # everything sums up to list of files in dir minus the checksum file plus the deleted files
-            if result.dbname in files: files.remove(result.dbname)
-            result.results.files_total += len(files)
-            result.results.files_total += result.results.files_deleted
+        if filenames is None:
+            total.dirs_total += 1  # Account for this starting directory
+            results = self.iter_validate(path)
+        else:
+            results = self.iter_validate_listed(path, filenames)
+        for result in results:
             total += result.results
 
-
         print ("Summary")
         print (total)
 
+    def iter_validate(self, path, store=None):
+        """
+            Validate the tree under path one directory at a time, yielding the
+            DirChecksum for each directory once it's done
+        """
+        if store is None:
+            store = ChecksumStore(self.fsync_batch, self.fast_scan)
+        try:
+            for result in self._validate_tree(path, store):
+                yield result
+        finally:
+            store.close()
+            self.engine.close()
+
+    def iter_validate_listed(self, path, filenames, store=None):
+        """
+            Validate just the files named in filenames (relative to path, or
+            absolute paths under it), yielding the DirChecksum for each directory
+            they're in.  Only those directories' checksum files are read, and
+            only the listed entries in them are checked or updated.
+        """
+        if store is None:
+            store = ChecksumStore(self.fsync_batch, self.fast_scan)
+        try:
+            for result in self._run_window(self._listed_dirs(path, filenames, store)):
+                yield result
+        finally:
+            store.close()
+            self.engine.close()
+
+    def _validate_tree(self, path, store):
+        if not self.detect_moves:
+            return self._run_window(self._walk(path, store))
+        return self._validate_tree_with_moves(path, store)
+
+    def _validate_tree_with_moves(self, path, store):
+        """
+            Missing and new files are held back during the walk, then matched
+            up, and each directory that had any gets checked again for just
+            those files
+        """
+        moves = MoveTracker()
+        for result in self._run_window(self._walk(path, store, moves)):
+            yield result
+        held_back = moves.resolve()
+        # Directories that were new in the walk may only have unrenamed tmp files so far
+        store.sync()
+        for result in self._run_window(self._held_back_dirs(path, held_back, store)):
+            yield result
+
+    def _held_back_dirs(self, path, held_back, store):
+        for root in sorted(held_back):
+            try:
+                dc = self._dir_checksum(root, store, os.path.relpath(root, path))
+            except DirectoryMissing:
+                logging.warning("Skipping %s, which no longer exists" % root)
+                continue
+            dc.held_back = held_back[root]
+            yield dc
+
+    def _walk(self, path, store, moves=None):
+        """
+            Yields a DirChecksum for each directory in the same order as
+            os.walk.  Each one must be started before asking for the next, as
+            its listing is reused to find the sub-directories.
+        """
+        to_visit = [path]
+        while to_visit:
+            root = to_visit.pop()
+            dc = self._dir_checksum(root, store, os.path.relpath(root, path))
+            dc.moves = moves
+            yield dc
+            subdirs, files = dc.list_dir()
+            to_visit.extend(self._subdirs_to_descend(root, subdirs)[::-1])
+
+    def _listed_dirs(self, path, filenames, store):
+        by_dir = {}
+        for filename in filenames:
+            filename = os.path.relpath(os.path.join(path, filename), path)
+            if filename == os.pardir or filename.startswith(os.pardir + os.sep):
+                logging.warning("Skipping %s, which isn't under %s" % (filename, path))
+                continue
+            if self.path_filter is not None and self.path_filter.excluded_path(filename.replace(os.sep, '/')):
+                continue
+            dirname, name = os.path.split(filename)
+            by_dir.setdefault(dirname, set()).add(name)
+
+        for dirname in sorted(by_dir):
+            root = os.path.normpath(os.path.join(path, dirname))
+            if not os.path.isdir(root):
+                logging.warning("Skipping %s, which no longer exists" % root)
+                continue
+            dc = self._dir_checksum(root, store, dirname or '.')
+            dc.only = by_dir[dirname]
+            yield dc
+
+    def _run_window(self, dcs):
+        """
+            Directories are started (their files queued on the engine) ahead of
+            the one being waited on, up to lookahead_bytes of queued data, so
+            the engine always has a mix of files to schedule.  They are still
+            finished and yielded in the order they came in.
+        """
+        window = collections.deque() # Started, but not finished yet
+        try:
+            for dc in dcs:
+                while window and not (self.engine.queued_bytes < self.lookahead_bytes
+                                      and len(window) < self.lookahead_dirs):
+                    yield self._finish(window)
+                started = time.time()
+                dc.start()
+                self._observe('start', started)
+                window.append(dc)
+            while window:
+                yield self._finish(window)
+        finally:
+            for dc in window:
+                dc.abandon()
+
+    def _finish(self, window):
+        self.engine.run(until=lambda: window[0].done)
+        result = window.popleft()
+        started = time.time()
+        result.finish()
+        self._observe('commit', started)
+        if self.metrics is not None:
+            self.metrics.dir_done()
+
+        # Make a sanity check of the total files processed by making sure
+        # everything sums up to list of files in dir minus the checksum file plus the deleted files
+        if result.checked is not None:
+            files = result.checked
+        else:
+            subdirs, files = result.list_dir()
+            files = [f for f in files if f != result.dbname]
+        result.results.files_total += len(files)
+        result.results.files_total += result.results.files_deleted
+        return result
+
     def scan(self, path):
         """
             Scan a directory recursively to build up a count and total size to get ETA
@@ -59,15 +232,21 @@ class CheckDirs(object):
         n_files = 0
         sz_files = 0
 
-        for root, subdirs, files in os.walk(path):
-            print("\rScanned %d directories..." % n_dirs, end='')
+        store = ChecksumStore()
+        to_visit = [path]
+        while to_visit:
+            root = to_visit.pop()
+            if not self.quiet:
+                print("\rScanned %d directories..." % n_dirs, end='')
+            started = time.time()
+            subdirs, file_sizes = self._scan_dir(root, store, os.path.relpath(root, path))
+            self._observe('scan', started)
             n_dirs += len(subdirs)
-            for f in files:
-                if f != self.dbname:
-                    n_files += 1
-                    stats = os.stat(os.path.join(root,f))
-                    sz_files += stats.st_size
-        print()
+            n_files += len(file_sizes)
+            sz_files += sum(file_sizes)
+            to_visit.extend(self._subdirs_to_descend(root, subdirs)[::-1])
+        if not self.quiet:
+            print()
         self.work = { 'dirs': n_dirs,
                       'files': n_files,
                       'size': sz_files
@@ -75,6 +254,36 @@ class CheckDirs(object):
 
         return n_dirs, n_files, sz_files
 
+    def _scan_dir(self, root, store, rel_dir='.'):
+        """
+            Returns the sub-directories and file sizes in root.  In fast_scan
+            mode, the ones saved in the checksum file are used if the directory
+            hasn't been modified since, which saves a stat per file.
+        """
+        checksum_file = os.path.join(root, self.dbname)
+        if self.fast_scan and os.path.isfile(checksum_file):
+            hashes = store.load(checksum_file)
+            if same_dir_stat(hashes.get('dir_stat'), get_dir_stat(root)) and same_filter(self.path_filter, hashes):
+                subdirs, files = hashes['dirs'], list(hashes['files'])
+                if self.path_filter is not None:
+                    # Excluded entries are kept in the checksum file, but don't count
+                    subdirs, files = self.path_filter.filter_listing(rel_dir, subdirs, files, root)
+                return subdirs, [hashes['files'][f]['size'] for f in files]
+
+        root, subdirs, files = os.walk(root).next()
+        files = store.without_tmp_files(checksum_file, files)
+        if self.path_filter is not None:
+            subdirs, files = self.path_filter.filter_listing(rel_dir, subdirs, files, root)
+        return subdirs, [os.stat(os.path.join(root,f)).st_size for f in files if f != self.dbname]
+
+    def _observe(self, phase, started):
+        if self.metrics is not None:
+            self.metrics.observe(phase, time.time() - started)
+
+    def _subdirs_to_descend(self, root, subdirs):
+        # os.walk lists symlinks to directories but doesn't follow them
+        return [os.path.join(root, d) for d in subdirs if not os.path.islink(os.path.join(root, d))]
+
 
 
 
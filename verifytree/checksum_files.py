@@ -0,0 +1,170 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Class to checksum a list of files, and to check them again later
+
+    The output has one ``<hash>  <filename>`` line per file, in the same
+    line format as sha256sum.  The hashes are xxh64, so the lists can be
+    checked with ``xxhsum -c`` (but not sha256sum).
+    File names with a backslash or newline in them get escaped the way
+    sha256sum does it (the line starts with a backslash).
+"""
+from __future__ import print_function
+import os, sys, stat
+from hash_engine import HashEngine, inode_key
+
+
+def read_file_list(stream, null=False):
+    """
+        Yields the file names listed in stream, one per line, or separated by
+        NUL characters (as written by find -print0) if null is set
+    """
+    if not null:
+        for line in stream:
+            line = line.rstrip('\n')
+            if line:
+                yield line
+        return
+    pending = ''
+    while True:
+        data = stream.read(65536)
+        if not data:
+            break
+        names = (pending + data).split('\0')
+        pending = names.pop()
+        for name in names:
+            if name:
+                yield name
+    if pending:
+        yield pending
+
+
+def format_line(_hash, filename):
+    if '\\' in filename or '\n' in filename:
+        return '\\%s  %s' % (_hash, filename.replace('\\', '\\\\').replace('\n', '\\n'))
+    return '%s  %s' % (_hash, filename)
+
+
+def parse_line(line):
+    """
+        Returns (hash, filename) from a checksum line, or None if it isn't one
+    """
+    line = line.rstrip('\n')
+    escaped = line.startswith('\\')
+    if escaped:
+        line = line[1:]
+    parts = line.split(' ', 1)
+    if len(parts) != 2 or not parts[0] or parts[1][:1] not in (' ', '*'):
+        return None
+    _hash, filename = parts[0], parts[1][1:] # Skip the text/binary mode marker
+    if escaped:
+        filename = filename.replace('\\\\', '\0').replace('\\n', '\n').replace('\0', '\\')
+    return _hash.lower(), filename
+
+
+class ChecksumFiles(object):
+
+    def __init__(self, engine=None):
+        self.engine = engine or HashEngine()
+        self.engine.show_progress = False  # It would get mixed up with the checksum lines
+        self.batch_files = 1024 # Files to hash in parallel before writing out their lines
+        self.out = sys.stdout
+        self.err = sys.stderr
+
+    def checksum(self, filenames):
+        """
+            Print a checksum line for each file
+
+            :param filenames: Iterable of file names
+            :returns: Number of files that couldn't be read
+        """
+        errors = 0
+        for batch, _hashes in self._hash_batches(filenames):
+            for filename, _hash in zip(batch, _hashes):
+                if _hash is None:
+                    print("verifytree: %s: could not read file" % filename, file=self.err)
+                    errors += 1
+                else:
+                    print(format_line(_hash, filename), file=self.out)
+        return errors
+
+    def check(self, lines):
+        """
+            Hash the files listed in checksum lines again and print whether
+            each one still matches
+
+            :param lines: Iterable of lines as written by :meth:`checksum`
+            :returns: (number of mismatches, number of files that couldn't be read)
+        """
+        expected = {}
+        def filenames():
+            for line in lines:
+                parsed = parse_line(line)
+                if parsed is None:
+                    if line.strip():
+                        print("verifytree: skipping improperly formatted line: %s" % line.rstrip('\n'), file=self.err)
+                    continue
+                _hash, filename = parsed
+                expected[filename] = _hash
+                yield filename
+
+        mismatches = errors = 0
+        for batch, _hashes in self._hash_batches(filenames()):
+            for filename, _hash in zip(batch, _hashes):
+                if _hash is None:
+                    print("%s: FAILED open or read" % filename, file=self.out)
+                    errors += 1
+                elif _hash != expected[filename]:
+                    print("%s: FAILED" % filename, file=self.out)
+                    mismatches += 1
+                else:
+                    print("%s: OK" % filename, file=self.out)
+            expected.clear()
+        if errors:
+            print("verifytree: WARNING: %d listed file%s could not be read" % (errors, '' if errors == 1 else 's'), file=self.err)
+        if mismatches:
+            print("verifytree: WARNING: %d computed checksum%s did NOT match" % (mismatches, '' if mismatches == 1 else 's'), file=self.err)
+        return mismatches, errors
+
+    def _hash_batches(self, filenames):
+        """
+            Yields (filenames, hashes) a batch at a time, so lines start coming
+            out before the whole list has been hashed.  Hashes are None for
+            files that couldn't be read.
+        """
+        batch = []
+        for filename in filenames:
+            batch.append(filename)
+            if len(batch) >= self.batch_files:
+                yield batch, self._hash_batch(batch)
+                batch = []
+        if batch:
+            yield batch, self._hash_batch(batch)
+
+    def _hash_batch(self, batch):
+        readable, sizes, keys, inos = [], [], [], []
+        for filename in batch:
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                continue
+            readable.append(filename)
+            sizes.append(st.st_size)
+            keys.append(inode_key(st))
+            inos.append(st.st_ino)
+        _hashes = dict(zip(readable, self.engine.hash_files(readable, sizes, keys, inos)))
+        return [_hashes.get(filename) for filename in batch]
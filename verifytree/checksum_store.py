@@ -0,0 +1,189 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Class to read and write the per-directory checksum files
+
+    Saves are deferred and coalesced, so a directory that gets modified several
+    times during a validation run is only written once when it is committed.
+    Each write goes to a temporary file in the same directory which is fsync'ed
+    and then renamed over the old checksum file, so a crash never leaves a
+    truncated checksum file behind.  Optionally, the fsyncs for several
+    directories can be batched together.  Temporary files never show up in
+    a directory's listing, and any left behind by a run that crashed get
+    removed the next time the directory is listed.
+
+    With keep_dir_mtime (for --fast-scan), if the hashes carry a 'dir_stat'
+    recorded when the directory was listed, and the directory hasn't been
+    touched since, its mtime is put back after the rename so that writing
+    the checksum file doesn't make the directory look modified on the next
+    run.
+"""
+import os, errno, logging
+import yaml
+from utils import get_dir_stat, same_dir_stat
+
+
+class ChecksumStore(object):
+
+    def __init__(self, fsync_batch=1, keep_dir_mtime=False):
+        self.fsync_batch = max(1, fsync_batch)
+        self.keep_dir_mtime = keep_dir_mtime # Put back the directory mtime after writing its checksum file
+        self._pending = {}      # checksum file -> hashes waiting to be committed
+        self._unsynced = []     # (tmp file, checksum file, ...) written but not yet synced/renamed
+        self._loaded = (None, None) # Most recently loaded checksum file
+
+    def load(self, checksum_file):
+        if checksum_file in self._pending:
+            return self._pending[checksum_file]
+        if self._loaded[0] == checksum_file:
+            return self._loaded[1]
+        with open(checksum_file) as f:
+            hashes = yaml.load(f)
+        self._loaded = (checksum_file, hashes)
+        return hashes
+
+    def save(self, hashes, checksum_file):
+        """
+            Mark the hashes as needing to be written out.  Nothing touches the
+            disk until :meth:`commit` is called for this checksum file.
+        """
+        self._pending[checksum_file] = hashes
+        if self._loaded[0] == checksum_file:
+            self._loaded = (None, None)
+
+    def discard(self, checksum_file):
+        """
+            Forget any pending changes to this checksum file
+        """
+        self._pending.pop(checksum_file, None)
+        if self._loaded[0] == checksum_file:
+            self._loaded = (None, None)
+
+    def is_dirty(self, checksum_file):
+        return checksum_file in self._pending
+
+    def commit(self, checksum_file):
+        """
+            Write out the pending hashes for this checksum file (if any)
+        """
+        hashes = self._pending.pop(checksum_file, None)
+        if hashes is None:
+            return
+        dirname = os.path.dirname(checksum_file) or '.'
+        # Only put the mtime back if nobody else touched the directory since it was listed
+        orig_stat = None
+        if self.keep_dir_mtime and same_dir_stat(hashes.get('dir_stat'), get_dir_stat(dirname)):
+            orig_stat = os.stat(dirname)
+        tmp_file = self._write_tmp(hashes, checksum_file)
+        tmp_dir_stat = get_dir_stat(dirname)
+        self._unsynced.append((tmp_file, checksum_file, orig_stat, tmp_dir_stat))
+        if len(self._unsynced) >= self.fsync_batch:
+            self.sync()
+
+    def sync(self):
+        """
+            Fsync all the temporary files written so far, rename them into place,
+            and then fsync each of the affected directories once.
+        """
+        if not self._unsynced:
+            return
+        for tmp_file, checksum_file, orig_stat, tmp_dir_stat in self._unsynced:
+            fd = os.open(tmp_file, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        dirs = []
+        for tmp_file, checksum_file, orig_stat, tmp_dir_stat in self._unsynced:
+            dirname = os.path.dirname(checksum_file) or '.'
+            unchanged = orig_stat is not None and same_dir_stat(tmp_dir_stat, get_dir_stat(dirname))
+            os.rename(tmp_file, checksum_file)
+            if unchanged:
+                self._restore_mtime(dirname, orig_stat)
+            if dirname not in dirs:
+                dirs.append(dirname)
+        self._unsynced = []
+        for dirname in dirs:
+            self._fsync_dir(dirname)
+
+    def close(self):
+        """
+            Commit everything that is still pending and flush it to disk
+        """
+        for checksum_file in list(self._pending):
+            self.commit(checksum_file)
+        self.sync()
+
+    def without_tmp_files(self, checksum_file, files):
+        """
+            Returns the file names in a directory listing, leaving out the
+            temporary files for checksum_file.  Ones left behind by a run
+            that's no longer going are removed.
+        """
+        prefix = os.path.basename(checksum_file) + '.tmp.'
+        kept = []
+        for f in files:
+            if not f.startswith(prefix):
+                kept.append(f)
+                continue
+            pid = f[len(prefix):]
+            if pid.isdigit() and not _is_running(int(pid)):
+                tmp_file = os.path.join(os.path.dirname(checksum_file), f)
+                logging.info("Removing %s, left behind by an earlier run" % tmp_file)
+                try:
+                    os.remove(tmp_file)
+                except OSError as e:
+                    logging.debug("Could not remove %s: %s" % (tmp_file, e))
+        return kept
+
+    def _write_tmp(self, hashes, checksum_file):
+        tmp_file = '%s.tmp.%d' % (checksum_file, os.getpid())
+        logging.debug("Writing %s" % tmp_file)
+        with open(tmp_file, 'w') as f:
+            f.write(yaml.dump(hashes))
+        return tmp_file
+
+    def _restore_mtime(self, dirname, st):
+        try:
+            if hasattr(st, 'st_mtime_ns'):
+                os.utime(dirname, ns=(st.st_atime_ns, st.st_mtime_ns))
+            else:
+                os.utime(dirname, (st.st_atime, st.st_mtime))
+        except OSError as e:
+            # Not our directory, so it'll just look modified next time
+            logging.debug("Could not restore mtime on %s: %s" % (dirname, e))
+
+    def _fsync_dir(self, dirname):
+        try:
+            fd = os.open(dirname, os.O_RDONLY)
+        except OSError:
+            return # Not every platform lets you open a directory
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+
+def _is_running(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM # Someone else's process
+    return True
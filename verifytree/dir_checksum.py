@@ -16,9 +16,13 @@
 """ Class to represent a directory of files and their checksums
 
 """
-import os, logging, copy
-from file_checksum import FileChecksum
-import yaml, tabulate
+from __future__ import print_function
+import os, logging, copy, time
+from hash_engine import HashEngine, inode_key
+from checksum_store import ChecksumStore
+from utils import get_dir_stat, same_dir_stat, is_racy_dir_stat, format_duration
+from path_filter import same_filter
+from archive_checksum import ArchiveChecksum, is_archive
 from exceptions import *
 
 class Results(object):
@@ -32,6 +36,8 @@ class Results(object):
         self.files_chksum_error = 0
         self.files_size_error = 0
         self.files_disk_error = 0
+        self.files_stalled = 0
+        self.files_moved = 0
 
         self.dirs_total = 0
         self.dirs_missing = 0
@@ -57,6 +63,7 @@ class Results(object):
         return sumr
 
     def __str__ (self):
+        import tabulate # Only needed for the summary, so keep it off the import path
         res = []
         headers = [x for x in self.__dict__ if x.startswith('dirs_')]
         table = [ [self.__dict__[x] for x in headers] ]
@@ -70,112 +77,346 @@ class Results(object):
         return '\n\n'.join(res)
 
 
+# Kinds of findings, named after the Results counter each one adds to
+FILE_NEW = 'files_new'
+FILE_DELETED = 'files_deleted'
+FILE_CHANGED = 'files_changed'
+FILE_VALIDATED = 'files_validated'
+FILE_CHKSUM_ERROR = 'files_chksum_error'
+FILE_SIZE_ERROR = 'files_size_error'
+FILE_DISK_ERROR = 'files_disk_error'
+FILE_STALLED = 'files_stalled'
+FILE_MOVED = 'files_moved'
+DIR_NEW = 'dirs_new'
+DIR_MISSING = 'dirs_missing'
+
+
+class Finding(object):
+    """
+        One thing found while validating a directory
+
+        :ivar kind: One of the FILE_* or DIR_* constants
+        :ivar path: Full path of the file or sub-directory
+        :ivar expected: The recorded value (hash or size) for checksum and size errors
+        :ivar actual: The value found on disk for checksum and size errors
+    """
+    __slots__ = ('kind', 'path', 'expected', 'actual')
+
+    def __init__(self, kind, path, expected=None, actual=None):
+        self.kind = kind
+        self.path = path
+        self.expected = expected
+        self.actual = actual
+
+    def __repr__(self):
+        return 'Finding(%r, %r, expected=%r, actual=%r)' % (self.kind, self.path, self.expected, self.actual)
+
+
 class DirChecksum(object):
 
-    def __init__ (self, path, dbname, work_tally):
+    def __init__ (self, path, dbname, work_tally, store=None, engine=None):
         self.path = path
         self.work_tally = work_tally
         if not os.path.exists(self.path):
             raise DirectoryMissing('%s does not exist' % self.path)
-        self.fc = FileChecksum()
+        if engine is None:
+            engine = HashEngine()
+        self.engine = engine
         self.dbname = dbname
+        if store is None:
+            store = ChecksumStore()
+        self.store = store
         self.results = Results()
         self.results.directory = self.path
         self.update_hash_files = False
         self.force_update_hash_files = False
         self.freshen_hash_files = False
+        self.quiet = False     # Don't print anything
+        self.listener = None   # Called with each Finding
+        self.fast_scan = False # Reuse the saved file list if the directory mtime hasn't changed
+        self.only = None       # Just check these file names instead of the whole directory
+        self.path_filter = None # path_filter.PathFilter of files and sub-directories to leave out
+        self.rel_dir = '.'     # Where this directory is relative to the top of the tree, for path_filter
+        self.xattrs = None     # Optional hash_xattrs.HashXattrs to keep a copy of each hash on the file itself
+        self.archives = False  # Also hash each member of tar and zip archives
+        self.moves = None      # Optional move_tracker.MoveTracker to hold back missing and new files in
+        self.held_back = None  # move_tracker.Moves for this directory, when checking what was held back
+        self.checked = None    # Files that were checked when only is set
+        self.dir_stat = None
+        self.listed_at = None  # When the directory was listed
+        self._listing = None
+        self._excluded = set() # Files on disk that path_filter left out of the listing
+        self._listing_reused = False
+        self._hashes = None
+        self._outstanding = 0 # Files queued on the engine that haven't come back yet
+        self._started = False
                                 
+    def list_dir(self, hashes=None):
+        """
+            Returns the sub-directories and files in this directory, listing it
+            only once.  In fast_scan mode, the listing saved in the checksum file
+            is reused when the directory hasn't been modified since.
+        """
+        if self._listing is None:
+            self.dir_stat = get_dir_stat(self.path)
+            if self.fast_scan and hashes and same_dir_stat(hashes.get('dir_stat'), self.dir_stat) \
+                    and same_filter(self.path_filter, hashes):
+                dirs, files = list(hashes['dirs']), list(hashes['files']) + [self.dbname]
+                self._listing_reused = True
+            else:
+                root, dirs, files = os.walk(self.path).next()
+                self.listed_at = time.time()
+                files = self.store.without_tmp_files(os.path.join(self.path, self.dbname), files)
+            if self.path_filter is not None:
+                # The saved listing keeps the excluded entries too, but the same rules never need a stat
+                all_files = files
+                dirs, files = self.path_filter.filter_listing(self.rel_dir, dirs, files, self.path, self.dbname)
+                self._excluded = set(all_files) - set(files)
+            self._listing = (dirs, files)
+        return self._listing
+
+    def _excluded_file(self, name, entry, on_disk):
+        """
+            True if path_filter leaves out a file saved in the checksum file,
+            in which case its entry is kept as it is instead of being checked
+            or dropped
+        """
+        if self.path_filter is None or name in on_disk:
+            return False
+        # Not in the listing, so either it was filtered out, or it's gone and goes by its saved entry
+        return name in self._excluded or self.path_filter.excluded_record(self.rel_dir, name, entry)
+
+    def _checked_files(self, file_hashes, on_disk):
+        """
+            Returns the names in file_hashes that path_filter doesn't leave out
+        """
+        return [f for f in file_hashes if not self._excluded_file(f, file_hashes[f], on_disk)]
+
+    def _excluded_dirs(self, hashes):
+        """
+            Returns the sub-directories saved in the checksum file that
+            path_filter leaves out, which are kept as they are
+        """
+        if self.path_filter is None:
+            return []
+        return [d for d in hashes['dirs'] if self.path_filter.excluded_record(self.rel_dir, d, is_dir=True)]
+
+    def _record_dir_stat(self, hashes):
+        # Only remember the directory stat if the saved listing matches what's on disk
+        dirs, files = self.list_dir()
+        on_disk = set(files) - set([self.dbname])
+        if set(self._checked_files(hashes['files'], on_disk)) == on_disk \
+                and set(hashes['dirs']) - set(self._excluded_dirs(hashes)) == set(dirs) \
+                and not (self.path_filter and self.path_filter.needs_stat) \
+                and not (self.listed_at is not None and is_racy_dir_stat(self.dir_stat, self.listed_at)):
+            hashes['dir_stat'] = self.dir_stat
+            if self.path_filter is None:
+                hashes.pop('filter', None)
+            else:
+                hashes['filter'] = self.path_filter.signature # What the listing was filtered with
+        else:
+            hashes.pop('dir_stat', None)
+            hashes.pop('filter', None)
+
+    def _say(self, msg):
+        if not self.quiet:
+            print(msg)
+
+    def _report(self, kind, path, msg=None, expected=None, actual=None):
+        """
+            Count a finding in the results, hand it to the listener, and print
+            msg (if any) on the console
+        """
+        setattr(self.results, kind, getattr(self.results, kind) + 1)
+        if self.listener is not None:
+            self.listener(Finding(kind, path, expected, actual))
+        if msg is not None:
+            self._say(msg)
+
     def generate_checksum(self, checksum_filename):
-        root, dirs, files = os.walk(self.path).next()
-        hashes = {  'dirs': dirs,
+        root = self.path
+        dirs, files = self.list_dir()
+        hashes = {  'dirs': copy.copy(dirs),
                     'files': {}
                 }
-        for filename in files:
-            entry = self._gen_file_checksum(os.path.join(root,filename))
-            if filename != self.dbname:
-                hashes['files'][filename] = entry
-                self.results.files_new += 1
-
-        # Write out the hashes for the current directory
-        logging.debug(hashes)
+        files = [f for f in files if f != self.dbname]
+        files = self._hold_back_new(files)
+        entries = self._gen_file_checksums([os.path.join(root,f) for f in files], reuse=True)
+        for filename, entry in zip(files, entries):
+            hashes['files'][filename] = entry
+            self._report(FILE_NEW, os.path.join(root, filename))
 
         return hashes
 
-    def _gen_file_checksum(self, filename):
-        fstat = os.stat(filename)
-        file_entry = { 'size': fstat.st_size,
-                       'mtime': fstat.st_mtime,
-                       }
-        
-        _hash = self.fc.get_hash(filename)
+    def _gen_file_checksums(self, filenames, done=None, reuse=False, fstats=None):
+        """
+            Build the checksum entries for a batch of files.  The hashing gets
+            queued on the engine, and each entry's hash is filled in (and done
+            called with the entry) once that file has been hashed.  done
+            returns whether the new hash was accepted.
+
+            With reuse, a hash saved in the file's xattrs is used as is if the
+            file hasn't changed since.
+
+            With archives set, tar and zip files get a 'members' dict of
+            member name -> {'size', 'hash'} as well.
+
+            :param fstats: os.stat of each file, if the caller already has them
+        """
+        file_entries = []
+        for i, filename in enumerate(filenames):
+            fstat = fstats[i] if fstats is not None else os.stat(filename)
+            file_entry = { 'size': fstat.st_size,
+                           'mtime': fstat.st_mtime,
+                           'ino': fstat.st_ino,
+                           'hash': "",
+                           }
+            file_entries.append(file_entry)
+            if self.archives and is_archive(filename):
+                # Can't reuse the xattrs hash, as the members have to be read anyway
+                self._outstanding += 1
+                self.engine.submit(filename, fstat.st_size,
+                                   lambda result, filename=filename, file_entry=file_entry, fstat=fstat: self._hashed_archive(filename, file_entry, fstat, result, done),
+                                   get_hash=ArchiveChecksum(self.engine.fc).get_hash, ino=fstat.st_ino)
+                continue
+            if reuse and self.xattrs is not None:
+                _hash = self.xattrs.get(filename, fstat)
+                if _hash is not None:
+                    file_entry['hash'] = _hash
+                    continue
+            self._outstanding += 1
+            self.engine.submit(filename, fstat.st_size,
+                               lambda _hash, filename=filename, file_entry=file_entry, fstat=fstat: self._hashed(filename, file_entry, fstat, _hash, done),
+                               inode_key(fstat), ino=fstat.st_ino)
+        return file_entries
+
+    def _hashed(self, filename, file_entry, fstat, _hash, done):
+        self._outstanding -= 1
         if _hash:
             file_entry['hash'] = _hash
         else:
             # Hmm, some kind of error (IOError!)
-            print("ERROR: file %s disk error while generating checksum" % (filename))
             file_entry['hash'] = ""
-            self.results.files_disk_error += 1
-        return file_entry
+            if filename in self.engine.stalled:
+                self._report(FILE_STALLED, filename, "ERROR: file %s stopped responding while generating checksum" % (filename))
+            else:
+                self._report(FILE_DISK_ERROR, filename, "ERROR: file %s disk error while generating checksum" % (filename))
+        accepted = done(file_entry) if done is not None else True
+        if _hash and accepted and self.xattrs is not None:
+            self.xattrs.set(filename, fstat, _hash)
+
+    def _hashed_archive(self, filename, file_entry, fstat, result, done):
+        _hash, members = result if result is not None else (None, None)
+        if members is not None:
+            file_entry['members'] = members
+        self._hashed(filename, file_entry, fstat, _hash, done)
 
     def _load_checksums(self, checksum_file):
-        with open(checksum_file) as f:
-            hashes = yaml.load(f)
-        return hashes
+        return self.store.load(checksum_file)
 
     def _save_checksums(self, hashes, checksum_file):
-        with open(checksum_file, 'w') as f:
-            f.write(yaml.dump(hashes))
+        # Only queues the write; everything gets written once in validate()
+        self.store.save(hashes, checksum_file)
 
-    def _check_hashes(self, root, hashes, checksum_file):
-        file_hashes = copy.deepcopy(hashes['files'])
-        update = False
+    def _check_hashes(self, root, hashes, checksum_file, names=None):
+        file_hashes = hashes['files']
+        if names is None:
+            names = list(file_hashes)
         #print("Checking %d files" % (len(hashes['files'])))
         if self.freshen_hash_files:
-            for f, stats in hashes['files'].items():
-                if stats['hash'] == '' or stats['hash'] is None:
-                    full_path = os.path.join(root, f)
-                    self.results.files_new += 1
-                    print("Freshening file %s" % (f))
-                    file_hashes[f] = self._gen_file_checksum(full_path)
-                    update = True
+            to_freshen = [f for f in names if file_hashes[f]['hash'] == '' or file_hashes[f]['hash'] is None]
+            for f in to_freshen:
+                self._report(FILE_NEW, os.path.join(root, f), "Freshening file %s" % (f))
+            entries = self._gen_file_checksums([os.path.join(root, f) for f in to_freshen])
+            for f, entry in zip(to_freshen, entries):
+                file_hashes[f] = entry
+            if to_freshen:
+                self._save_checksums(hashes, checksum_file)
 
         else:
-            for f, stats in hashes['files'].items():
+            to_update = []  # New hash gets accepted as is
+            to_verify = []  # New hash gets compared against the recorded one
+            to_save = False
+            fstats = {}     # Reused when hashing, so each file only gets stat'ed once
+            for f in names:
+                stats = file_hashes[f]
                 full_path = os.path.join(root, f)
-                fstat = os.stat(full_path)
+                fstat = fstats[f] = os.stat(full_path)
                 if fstat.st_mtime != int(stats['mtime']):
-                    print("File %s changed, updating hash" % (f))
-                    self.results.files_changed += 1
+                    self._report(FILE_CHANGED, full_path, "File %s changed, updating hash" % (f))
                     if self.update_hash_files:
-                        file_hashes[f] = self._gen_file_checksum(full_path)
-                        update = True
+                        to_update.append(f)
                 elif fstat.st_size != long(stats['size']):
-                    print("ERROR: file %s has changed in size from %s to %s" % (f, stats['size'], fstat.st_size))
-                    self.results.files_size_error += 1
+                    self._report(FILE_SIZE_ERROR, full_path, "ERROR: file %s has changed in size from %s to %s" % (f, stats['size'], fstat.st_size),
+                                 expected=stats['size'], actual=fstat.st_size)
                     if self.force_update_hash_files:
-                        file_hashes[f] = self._gen_file_checksum(full_path)
-                        update = True
-                        print("Updating checksum to new value")
+                        to_update.append(f)
+                        self._say("Updating checksum to new value")
                     else:
-                        print("Use -f option and rerun to force new checksum computation to accept changed file and get rid of this error")
+                        self._say("Use -f option and rerun to force new checksum computation to accept changed file and get rid of this error")
                 else:
                     # mtime and size look good, so now check the hashes
-                    #print (full_path)
-                    new_hash = self._gen_file_checksum(full_path)
-                    if new_hash['hash'] != stats.get('hash',""):
-                        print("ERROR: file %s hash has changed from %s to %s" % (f, stats['hash'], new_hash['hash']))
-                        self.results.files_chksum_error += 1
-                        if self.force_update_hash_files:
-                            file_hashes[f] = new_hash
-                            update=True
-                            print("Updating checksum to new value")
-                        else:
-                            print("Use -f option and rerun to force new checksum computation to accept changed file and get rid of this error")
-                    else:
-                        self.results.files_validated += 1
-        if update:
-            hashes['files'] = file_hashes
-            self._save_checksums(hashes,checksum_file) 
+                    to_verify.append(f)
+                    if self.moves is not None and self.update_hash_files and 'ino' not in stats:
+                        # Recorded by an older version; needed to spot it being moved next time
+                        stats['ino'] = fstat.st_ino
+                        to_save = True
+
+            entries = self._gen_file_checksums([os.path.join(root, f) for f in to_update],
+                                               fstats=[fstats[f] for f in to_update])
+            for f, entry in zip(to_update, entries):
+                file_hashes[f] = entry
+            if to_update or to_save:
+                self._save_checksums(hashes, checksum_file)
+            for f in to_verify:
+                self._gen_file_checksums([os.path.join(root, f)],
+                                         lambda new_hash, f=f: self._verify_hash(root, hashes, checksum_file, f, new_hash),
+                                         fstats=[fstats[f]])
+
+    def _verify_hash(self, root, hashes, checksum_file, f, new_hash):
+        stats = hashes['files'][f]
+        full_path = os.path.join(root, f)
+        if not new_hash['hash']:
+            # Couldn't be read, which _hashed already reported; keep the recorded hash
+            return False
+        if new_hash['hash'] != stats.get('hash',""):
+            if not self._report_members(full_path, stats, new_hash):
+                self._report(FILE_CHKSUM_ERROR, full_path, "ERROR: file %s hash has changed from %s to %s" % (f, stats['hash'], new_hash['hash']),
+                             expected=stats['hash'], actual=new_hash['hash'])
+            if self.force_update_hash_files:
+                hashes['files'][f] = new_hash
+                self._save_checksums(hashes, checksum_file)
+                self._say("Updating checksum to new value")
+                return True
+            else:
+                self._say("Use -f option and rerun to force new checksum computation to accept changed file and get rid of this error")
+                return False
+        else:
+            self._report(FILE_VALIDATED, full_path)
+            if 'members' in new_hash and 'members' not in stats and self.update_hash_files:
+                # Archive recorded before its members were being hashed
+                stats['members'] = new_hash['members']
+                self._save_checksums(hashes, checksum_file)
+            return True
+
+    def _report_members(self, full_path, stats, new_hash):
+        """
+            Report each member of an archive whose hash has changed, so it's
+            clear which ones are damaged.  Returns False if the members
+            weren't recorded, or they all still match, so the archive as a
+            whole needs reporting instead.
+        """
+        old_members = stats.get('members')
+        if not old_members:
+            return False
+        new_members = new_hash.get('members') or {}
+        damaged = [m for m in sorted(old_members) if new_members.get(m, {}).get('hash') != old_members[m]['hash']]
+        for m in damaged:
+            member_path = os.path.join(full_path, m)
+            actual = new_members[m]['hash'] if m in new_members else None
+            self._report(FILE_CHKSUM_ERROR, member_path, "ERROR: archive member %s hash has changed from %s to %s" % (member_path, old_members[m]['hash'], actual),
+                         expected=old_members[m]['hash'], actual=actual)
+        return len(damaged) > 0
 
 
     def _are_sub_dirs_same(self, hashes, root, dirs):
@@ -183,24 +424,25 @@ class DirChecksum(object):
         if 'dirs' in hashes:
             # Just a check for backwards compatibility with old versions that
             # did not save the subdirectory names
-            hashes_set = set(hashes['dirs'])
+            excluded = self._excluded_dirs(hashes)
+            hashes_set = set(hashes['dirs']) - set(excluded)
             disk_set = set(dirs)
 
             new_dirs = disk_set - hashes_set
             if len(new_dirs) != 0:
-                print("New sub-directories found:")
-                print ('\n'.join(["- %s" % (os.path.join(root,x)) for x in new_dirs]))
-                self.results.dirs_new += len(new_dirs)
+                self._say("New sub-directories found:")
+                for x in new_dirs:
+                    self._report(DIR_NEW, os.path.join(root,x), "- %s" % (os.path.join(root,x)))
 
             missing_dirs = hashes_set - disk_set
             if len(missing_dirs) != 0:
-                print("Missing sub-directories from last scan found:")
-                print ('\n'.join(["- %s" % (os.path.join(root,x)) for x in missing_dirs]))
-                self.results.dirs_missing += len(missing_dirs)
+                self._say("Missing sub-directories from last scan found:")
+                for x in missing_dirs:
+                    self._report(DIR_MISSING, os.path.join(root,x), "- %s" % (os.path.join(root,x)))
 
             if disk_set != hashes_set:
                 # There were differences, so we let's update the hashes
-                hashes['dirs'] = dirs
+                hashes['dirs'] = dirs + excluded
                 return False
             else:
                 return True
@@ -208,13 +450,15 @@ class DirChecksum(object):
             # Ah ha, the hashes files was created by an old version of this program
             # so just add it now
             hashes['dirs'] = copy.deepcopy(dirs)
-            self.results.dirs_new += len(dirs)
+            for x in dirs:
+                self._report(DIR_NEW, os.path.join(root,x))
             #print hashes
             return False
 
     def _validate_hashes(self, hashes, checksum_file):
         file_hashes = hashes['files']
-        root, dirs, files = os.walk(self.path).next()
+        root = self.path
+        dirs, files = self.list_dir(hashes)
 
         # First, make sure the sub-directories previously recorded are all here
         if not self._are_sub_dirs_same(hashes, root, dirs):
@@ -223,65 +467,182 @@ class DirChecksum(object):
                 self._save_checksums(hashes, checksum_file)
 
 
-        set_filenames_hashes = set(file_hashes.keys())
         set_filenames_disk = set(files)
         set_filenames_disk.remove(self.dbname)
+        checked = self._checked_files(file_hashes, set_filenames_disk)
+        set_filenames_hashes = set(checked)
 
         if set_filenames_hashes != set_filenames_disk: # Uh oh, different number of files on disk vs hash file
 
             # Remove any missing files and mark it
             missing_files = set_filenames_hashes - set_filenames_disk
+            held_back = set()
+            if self.moves is not None:
+                # Might have been moved somewhere else in the tree, so leave them until the end
+                held_back = set(f for f in missing_files if self.moves.add_missing(root, f, file_hashes[f]))
+                missing_files -= held_back
             if len(missing_files) > 0: # Files on disk deleted
-                print("Missing files since last validation")
+                self._say("Missing files since last validation")
                 for f in missing_files:
-                    print(f)
-                    self.results.files_deleted += 1
+                    self._report(FILE_DELETED, os.path.join(root,f), f)
                     del file_hashes[f]
             # Check all files previously checked minus the missing ones
-            self._check_hashes(root, hashes, checksum_file)
+            self._check_hashes(root, hashes, checksum_file, [f for f in checked if f in file_hashes and f not in held_back])
 
             # Add in the new files since last check
-            new_files = set_filenames_disk - set_filenames_hashes
+            new_files = self._hold_back_new(set_filenames_disk - set_filenames_hashes)
             if len(new_files) > 0: # New files on disk
-                print("New files detected since last validation")
-                for f in new_files:
-                    file_hashes[f] = self._gen_file_checksum(os.path.join(root,f))
-                    self.results.files_new += 1
+                self._say("New files detected since last validation")
+                new_files = list(new_files)
+                entries = self._gen_file_checksums([os.path.join(root,f) for f in new_files], reuse=True)
+                for f, entry in zip(new_files, entries):
+                    file_hashes[f] = entry
+                    self._report(FILE_NEW, os.path.join(root,f))
 
             if self.update_hash_files:
                 self._save_checksums(hashes, checksum_file)
                     
         else:
-            self._check_hashes(root, hashes, checksum_file)
-
-
-    def tally_dir(self, path):
-        root, dirs, files = os.walk(path).next()
+            self._check_hashes(root, hashes, checksum_file, checked)
+
+
+    def _hold_back_new(self, new_files):
+        """
+            Returns the new files that should be hashed now; with a move
+            tracker, they're all held back until the end of the run instead
+        """
+        if self.moves is None:
+            return list(new_files)
+        for f in new_files:
+            self.moves.add_new(self.path, f, os.stat(os.path.join(self.path, f)))
+        return []
+
+    def _validate_listed(self, hashes, checksum_file, names):
+        """
+            Like _validate_hashes, but only for the given file names; the rest
+            of the directory (and its sub-directories) is left alone
+        """
+        file_hashes = hashes['files']
+        root = self.path
+        names = sorted(set(names) - set([self.dbname]))
+        on_disk = [f for f in names if os.path.isfile(os.path.join(root, f))]
+        if self.path_filter is not None:
+            all_files = on_disk
+            dirs, on_disk = self.path_filter.filter_listing(self.rel_dir, [], on_disk, root)
+            self._excluded = set(all_files) - set(on_disk)
+        on_disk_set = set(on_disk)
+        missing_files = [f for f in names if f in file_hashes and f not in on_disk_set
+                         and not self._excluded_file(f, file_hashes[f], on_disk_set)]
+        new_files = [f for f in on_disk if f not in file_hashes]
+        # Files held back during the walk were already counted then
+        self.checked = on_disk if self.held_back is None else []
+        moved_in = self.held_back.moved_in if self.held_back is not None else {}
+        moved_out = self.held_back.moved_out if self.held_back is not None else set()
+
+        for f in missing_files:
+            if f not in moved_out:
+                self._report(FILE_DELETED, os.path.join(root,f), "Missing file %s" % f)
+            del file_hashes[f]
+
+        self._check_hashes(root, hashes, checksum_file, [f for f in on_disk if f in file_hashes])
+
+        for f in [f for f in new_files if f in moved_in]:
+            old_path, entry = moved_in[f]
+            file_hashes[f] = copy.copy(entry)
+            self._report(FILE_MOVED, os.path.join(root,f), "File %s moved from %s" % (f, old_path),
+                         expected=old_path, actual=os.path.join(root,f))
+        new_files = [f for f in new_files if f not in moved_in]
+
+        entries = self._gen_file_checksums([os.path.join(root,f) for f in new_files], reuse=True)
+        for f, entry in zip(new_files, entries):
+            file_hashes[f] = entry
+            self._report(FILE_NEW, os.path.join(root,f))
+
+        if (missing_files or new_files or moved_in) and self.update_hash_files:
+            self._save_checksums(hashes, checksum_file)
+
+    def tally_dir(self, path, hashes=None):
+        if self.work_tally is None:
+            return
+        dirs, files = self.list_dir()
         self.work_tally['dirs'] -= 1
-        file_size_list = [os.stat(os.path.join(root,f)).st_size for f in files if f != self.dbname]
+        if self._listing_reused:
+            file_size_list = [hashes['files'][f]['size'] for f in files if f != self.dbname]
+        else:
+            file_size_list = [os.stat(os.path.join(path,f)).st_size for f in files if f != self.dbname]
         self.work_tally['files'] -= len(file_size_list)
         self.work_tally['size'] -= sum(file_size_list)
 
 
     def validate(self):
-
-        #self.update_hash_files = update_hash_files
+        """
+            Validate the directory, waiting for all of its files to be hashed
+        """
+        self.start()
+        self.engine.run(until=lambda: self.done)
+        self.finish()
+
+    def start(self):
+        """
+            Check everything that doesn't need a hash, and queue the files that
+            do on the engine.  Once the engine has hashed them all (done is
+            True), call finish().
+        """
         checksum_filename = os.path.join(self.path, self.dbname)
-        print("Remaining: %d dirs, %d files, %7.2fGB" % (self.work_tally['dirs'], self.work_tally['files'], float(self.work_tally['size'])/2**30))
-        if not os.path.isfile(checksum_filename):
-            print("Generating checksums for new directory %s" % self.path)
-            hashes = self.generate_checksum(checksum_filename)
-            self._save_checksums(hashes, checksum_filename)
-        else:
-            #print ("Validating %s " % (self.path))
-            hashes = self._load_checksums(checksum_filename)
-            self._validate_hashes(hashes, checksum_filename)
-        self.tally_dir(self.path)
-
-
-
-        
-
-
-
-    
+        self._report_remaining()
+        try:
+            if self.only is not None or self.held_back is not None:
+                if os.path.isfile(checksum_filename):
+                    hashes = self._load_checksums(checksum_filename)
+                else:
+                    # Start the checksum file with just the listed files, rather than hashing the whole directory
+                    self._say("Generating checksums for listed files in new directory %s" % self.path)
+                    hashes = {'dirs': copy.copy(self.list_dir()[0]), 'files': {}}
+                    self._save_checksums(hashes, checksum_filename)
+                self._validate_listed(hashes, checksum_filename, self.only if self.only is not None else self.held_back.names())
+            elif not os.path.isfile(checksum_filename):
+                self._say("Generating checksums for new directory %s" % self.path)
+                hashes = self.generate_checksum(checksum_filename)
+                self._save_checksums(hashes, checksum_filename)
+            else:
+                #print ("Validating %s " % (self.path))
+                hashes = self._load_checksums(checksum_filename)
+                self._validate_hashes(hashes, checksum_filename)
+                if self.fast_scan and self.update_hash_files and not same_dir_stat(hashes.get('dir_stat'), self.dir_stat):
+                    # Refresh the saved directory stat so the next fast scan can skip this listing
+                    self._save_checksums(hashes, checksum_filename)
+        except VerificationCancelled:
+            self.abandon()
+            raise
+        self._hashes = hashes
+        self._started = True
+        self.tally_dir(self.path, hashes)
+
+    @property
+    def done(self):
+        return self._started and self._outstanding == 0
+
+    def finish(self):
+        """
+            Write out the checksum file now that all the hashes are in
+        """
+        checksum_filename = os.path.join(self.path, self.dbname)
+        logging.debug(self._hashes)
+        if self.store.is_dirty(checksum_filename):
+            self._record_dir_stat(self._hashes)
+        self.store.commit(checksum_filename)
+
+    def abandon(self):
+        """
+            Don't write out a half-checked directory
+        """
+        self.store.discard(os.path.join(self.path, self.dbname))
+
+    def _report_remaining(self):
+        if self.work_tally is None:
+            return
+        # Directories not started yet, plus files queued on the engine but not hashed yet
+        remaining_bytes = self.work_tally['size'] + self.engine.queued_bytes
+        eta = self.engine.eta(remaining_bytes)
+        self._say("Remaining: %d dirs, %d files, %7.2fGB, ETA: %s" % (self.work_tally['dirs'], self.work_tally['files'],
+                  float(remaining_bytes)/2**30, format_duration(eta) if eta is not None else '--'))
@@ -1,3 +1,6 @@
 
 class DirectoryMissing(Exception): pass
 
+class VerificationCancelled(Exception): pass
+
+class FileStalled(Exception): pass
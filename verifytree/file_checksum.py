@@ -15,18 +15,106 @@
 
 """ Class to generate file hash
 
+    The io_mode controls how much a run disturbs the page cache:
+
+    - buffered: Plain reads
+    - nocache: Plain reads, but tell the kernel to drop each chunk from the
+      page cache once it's hashed (posix_fadvise DONTNEED)
+    - direct: Read with O_DIRECT into a page-aligned buffer so the file never
+      goes through the page cache.  Falls back to nocache for filesystems that
+      refuse direct I/O.
+
+    With read_ahead set, large files are read on a separate thread into a
+    small ring of reusable buffers, up to read_ahead chunks ahead of the
+    hashing, so the disk keeps going while the hash is being worked out.
+    The next file can also be prefetched (posix_fadvise WILLNEED) while the
+    current one is hashed.
+
+    Read errors other than the file being missing or off limits are retried
+    a few times, waiting retry_backoff seconds before the first retry and
+    twice as long before each one after that, as network filesystems often
+    recover.
 """
-import os
-import hashlib, xxhash, frogress
+import os, sys, errno, mmap, io, time
+import itertools, threading, Queue
+import hashlib, xxhash
 import logging
 
 blocksize = 4096
+small_file_size = 65536 # Files up to this size are hashed with a single read
+io_mode = 'buffered'
+IO_MODES = ('buffered', 'nocache', 'direct')
+read_ahead = 4 # Chunks to read ahead of the hashing on another thread (0 to read and hash in turn)
+retries = 2
+retry_backoff = 1.0
+
+# Errors that won't go away by trying again
+_PERMANENT_ERRORS = set(getattr(errno, name) for name in
+                        ('ENOENT', 'ENOTDIR', 'EISDIR', 'EACCES', 'EPERM', 'ELOOP', 'ENAMETOOLONG') if hasattr(errno, name))
+
+DIRECT_IO_ALIGNMENT = 4096
+POSIX_FADV_WILLNEED = 3 # Linux values, for the ctypes fallback
+POSIX_FADV_DONTNEED = 4
+
+
+def _get_fadvise():
+    """
+        Returns a function of (fd, offset, length, advice) to tell the kernel
+        about part of a file, or None if the platform can't do that.  Python 2
+        has no os.posix_fadvise, so go through libc there.
+    """
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes, ctypes.util
+        posix_fadvise = ctypes.CDLL(ctypes.util.find_library('c')).posix_fadvise
+    except (OSError, AttributeError):
+        return None
+    posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    return posix_fadvise
+
+_fadvise = _get_fadvise()
+
+
+class _Position(object):
+    """
+        Just enough of a file object for frogress to show how far through
+        the file the chunks handed out by track() have got
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.pos = 0
+
+    def track(self, chunks):
+        for chunk in chunks:
+            self.pos += len(chunk)
+            yield chunk
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        pass
+
+    def fileno(self):
+        return -1
 
 
 class FileChecksum(object):
 
     def __init__(self):
         self.blocksize = blocksize
+        self.small_file_size = small_file_size
+        self.io_mode = io_mode
+        self.read_ahead = read_ahead
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.on_progress = None # Called after each chunk is hashed, for the stall watchdog
+        self.on_backoff = None  # Called with the seconds it's about to wait before a retry, for the stall watchdog
+        self.show_progress = True
 
     def _iter_file(self, f, blocksize):
         buf = f.read(blocksize)
@@ -34,32 +122,284 @@ class FileChecksum(object):
             yield buf
             buf = f.read(self.blocksize)
 
+    def _iter_file_nocache(self, filename, offset=0):
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            for buf in self._iter_file(f, self.blocksize):
+                yield buf
+                self._drop_cache(f.fileno(), offset, len(buf))
+                offset += len(buf)
+
+    def _iter_file_into(self, filename, buffers):
+        """
+            Read the file into each of the buffers in turn.  Each chunk is a
+            view into one of them, so it's only good until the reading comes
+            back round to that buffer.
+        """
+        with open(filename, 'rb') as f:
+            offset = 0
+            for buf in itertools.cycle(buffers):
+                n = f.readinto(buf)
+                if not n:
+                    return
+                yield buffer(buf, 0, n)
+                if self.io_mode == 'nocache':
+                    self._drop_cache(f.fileno(), offset, n)
+                offset += n
+
+    def _direct_buffers(self, n):
+        size = -(-self.blocksize // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT
+        return [mmap.mmap(-1, size) for i in range(n)] # Anonymous maps are page-aligned
+
+    def _iter_file_direct(self, filename, bufs=None):
+        """
+            Read the file with O_DIRECT into each of the aligned bufs in turn
+            (just one of its own if not given).  Each chunk is a view into one
+            of them, so it's only good until the reading comes back round to
+            that buffer.  If the filesystem won't do direct I/O, or a read
+            stops off a block boundary before the end of the file, the rest
+            comes from _iter_file_nocache.
+        """
+        offset = 0
+        fd = None
+        if hasattr(os, 'O_DIRECT'):
+            try:
+                fd = os.open(filename, os.O_RDONLY | os.O_DIRECT)
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+        if fd is not None:
+            own_bufs = bufs is None
+            if own_bufs:
+                bufs = self._direct_buffers(1)
+            size = len(bufs[0])
+            f = io.FileIO(fd, 'r')
+            try:
+                for buf in itertools.cycle(bufs):
+                    try:
+                        n = f.readinto(buf)
+                    except IOError as e:
+                        if e.errno != errno.EINVAL:
+                            raise
+                        break
+                    if not n:
+                        return
+                    yield buffer(buf, 0, n)
+                    offset += n
+                    if n < size and offset % DIRECT_IO_ALIGNMENT != 0:
+                        if offset >= os.fstat(fd).st_size:
+                            return
+                        break
+            finally:
+                f.close()
+                if own_bufs:
+                    bufs[0].close()
+        for chunk in self._iter_file_nocache(filename, offset):
+            yield chunk
+
+    def _read_ahead(self, chunks, depth):
+        """
+            Run the chunks generator on a reader thread, up to depth chunks
+            ahead of whoever is iterating over this.  Whatever the reader
+            raises gets raised here instead.
+        """
+        ready = Queue.Queue(depth)
+        stop = threading.Event()
+
+        def reader():
+            try:
+                for chunk in chunks:
+                    ready.put((chunk, None))
+                    if stop.is_set():
+                        break
+                else:
+                    ready.put((None, None))
+            except Exception as e:
+                ready.put((None, e))
+            finally:
+                chunks.close()
+
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                chunk, error = ready.get()
+                if error is not None:
+                    raise error
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            # Also gets here if the caller gives up part way, in which case the
+            # reader may need room on the queue to notice
+            stop.set()
+            while thread.is_alive():
+                try:
+                    ready.get(timeout=0.1)
+                except Queue.Empty:
+                    pass
+
+    def _iter_file_read_ahead(self, filename):
+        # The reader can be filling one buffer while depth are queued and one is being hashed
+        depth = self.read_ahead
+        if self.io_mode != 'direct':
+            return self._read_ahead(self._iter_file_into(filename, [bytearray(self.blocksize) for i in range(depth + 2)]), depth)
+        return self._iter_direct_read_ahead(filename, depth)
+
+    def _iter_direct_read_ahead(self, filename, depth):
+        # The maps can only be closed once the queued chunks are done with
+        bufs = self._direct_buffers(depth + 2)
+        chunks = self._read_ahead(self._iter_file_direct(filename, bufs), depth)
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            chunks.close()
+            for buf in bufs:
+                buf.close()
+
+    def iter_chunks(self, filename, filesize):
+        """
+            Returns the chunks of the file, read the way io_mode and
+            read_ahead say.  Each chunk may be a view into a buffer that gets
+            reused, so it's only good until the next one is asked for.
+        """
+        if self._reads_ahead(filesize):
+            return self._iter_file_read_ahead(filename)
+        if self.io_mode == 'direct':
+            return self._iter_file_direct(filename)
+        if self.io_mode == 'nocache':
+            return self._iter_file_nocache(filename)
+        return self._iter_file_buffered(filename)
+
+    def _reads_ahead(self, filesize):
+        # Not worth starting a thread for just a chunk or two
+        return self.read_ahead > 0 and filesize > 2 * self.blocksize
+
+    def _iter_file_buffered(self, filename):
+        with open(filename, 'rb') as f:
+            for buf in self._iter_file(f, self.blocksize):
+                yield buf
+
+    def prefetch(self, filename):
+        """
+            Ask the kernel to start reading in the first read_ahead chunks of
+            the file, so they are ready by the time it gets hashed
+        """
+        if _fadvise is None or self.read_ahead <= 0 or self.io_mode == 'direct':
+            return
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            _fadvise(fd, 0, self.read_ahead * self.blocksize, getattr(os, 'POSIX_FADV_WILLNEED', POSIX_FADV_WILLNEED))
+        finally:
+            os.close(fd)
+
+    def _drop_cache(self, fd, offset, length):
+        if _fadvise is not None:
+            _fadvise(fd, offset, length, getattr(os, 'POSIX_FADV_DONTNEED', POSIX_FADV_DONTNEED))
+
     def _get_file_size(self, filename):
         return os.stat(filename).st_size
 
-    def get_hash(self, filename):
+    def _hash_small_file(self, filename, filesize):
+        """
+            Hash the whole file from a single read, without any of the
+            generator or progress bar overhead.  One byte more than
+            small_file_size is asked for, so a file that has grown since it
+            was stat'ed still gets hashed in full.
+        """
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            data = os.read(fd, self.small_file_size + 1)
+            if filesize <= len(data) <= self.small_file_size:
+                return xxhash.xxh64_hexdigest(data)
+            # Short read, or the file grew, so stream the rest of it
+            hasher = xxhash.xxh64(data)
+            chunk = os.read(fd, self.blocksize)
+            while len(chunk) > 0:
+                hasher.update(chunk)
+                chunk = os.read(fd, self.blocksize)
+            return hasher.hexdigest()
+        finally:
+            if self.io_mode != 'buffered':
+                # Too small to bother with O_DIRECT, just drop it from the cache
+                self._drop_cache(fd, 0, 0)
+            os.close(fd)
+
+    def get_hash(self, filename, filesize=None):
+        """
+            Returns the hex digest of the file, or None if it couldn't be read
+
+            :param filesize: Size of the file if the caller already stat'ed it
+        """
+        if filesize is None:
+            filesize = self._get_file_size(filename)
+        return self.with_retries(filename, lambda: self._read_hash(filename, filesize))
+
+    def with_retries(self, filename, read):
+        """
+            Returns read(), trying it again after a backoff on read errors
+            that may go away, or None if it still fails after the retries.
+            Anything else that reads filename (like ArchiveChecksum) goes
+            through here too.
+        """
+        attempt = 0
+        while True:
+            try:
+                return read()
+            except (IOError, OSError) as e:
+                if e.errno in _PERMANENT_ERRORS or attempt >= self.retries:
+                    logging.debug("Could not read %s: %s" % (filename, e))
+                    return None
+                delay = self.retry_backoff * 2**attempt
+                logging.info("Could not read %s (%s), trying again in %.1fs" % (filename, e, delay))
+                if self.on_backoff is not None:
+                    self.on_backoff(delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def _read_hash(self, filename, filesize):
+        if filesize <= self.small_file_size:
+            _hash = self._hash_small_file(filename, filesize)
+            if self.show_progress:
+                print("100.0%% | [##########] | %s %d-bytes | ETA: -- | Time: 0.0s" % (filename, filesize))
+            return _hash
+
         #hasher = hashlib.md5()
         hasher = xxhash.xxh64()
 
+        if self.io_mode == 'buffered' and not self._reads_ahead(filesize):
+            with open(filename, 'rb') as f:
+                self._hash_chunks(hasher, self._iter_file(f, self.blocksize), f, filename)
+        else:
+            position = _Position(filename)
+            self._hash_chunks(hasher, position.track(self.iter_chunks(filename, filesize)), position, filename)
+
+        return hasher.hexdigest()
+
+    def _hash_chunks(self, hasher, chunks, source, filename):
+        if self.on_progress is not None:
+            chunks = self._track_progress(chunks)
+        if not self.show_progress:
+            for chunk in chunks:
+                hasher.update(chunk)
+            return
+
+        import frogress # Only needed for the progress bar
         widgets = [ frogress.PercentageWidget, 
                     frogress.BarWidget, 
                     frogress.TransferWidget(filename+' '),
                     frogress.EtaWidget,
                     frogress.TimerWidget]
-        filesize = self._get_file_size(filename)
-        try:
-            with open(filename, 'rb') as f:
-                chunks = self._iter_file(f, self.blocksize)
-                if filesize == 0:
-                    for chunk in chunks:
-                        hasher.update(chunk)
-                    print("100.0%% | [##########] | %s 0-bytes | ETA: -- | Time: 0.0s" % filename)  
-                else:
-                    for chunk in frogress.bar(chunks, source=f, widgets=widgets):
-                        hasher.update(chunk)
-                    print
-        except IOError as e:
-            return None
-
-        return hasher.hexdigest()
+        for chunk in frogress.bar(chunks, source=source, widgets=widgets):
+            hasher.update(chunk)
+        print
 
+    def _track_progress(self, chunks):
+        for chunk in chunks:
+            yield chunk
+            self.on_progress()
@@ -0,0 +1,515 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Class to hash files, optionally on a pool of threads
+
+    One engine is shared by all the directories in a run.  Files are queued
+    with submit() along with a callback for the result, and run() does the
+    hashing and calls the callbacks, always on the calling thread.  Because
+    the queue can hold the files of several directories at once, the
+    workers don't all sit idle waiting on one big file at the end of every
+    directory.  With more than one job, and no read_order, the largest
+    queued file is always handed out first (longest-processing-time
+    scheduling).  The engine also keeps the running totals used for
+    progress reporting and the ETA.
+
+    The queue can instead be read in a fixed order (read_order), which
+    matters a lot on spinning disks:
+
+    - none: As given
+    - name: By file name
+    - inode: By inode number, which tends to follow allocation order
+    - physical: By the disk offset of each file's first extent (Linux
+      FIEMAP), falling back to inode and then name order for files where
+      that isn't available.  Files up to small_file_size aren't worth
+      looking up, so they just go by inode.
+
+    The inode number given to submit() is used when there is one, so the
+    files don't get stat'ed again just to sort them.
+
+    Files submitted with a key (device, inode, size and mtime) are only
+    hashed once per key, so every hardlink to a file after the first just
+    gets the same hash.  The hashes are kept in a bounded LRU cache.
+
+    With a tuner (block_tuner.BlockTuner), each large file is read with the
+    block size picked for the device it's on.
+
+    With a stall_timeout, all the reading happens on worker threads (even
+    for one job), and a watchdog thread keeps an eye on them.  A worker
+    that hasn't got a chunk further for stall_timeout seconds is abandoned,
+    stuck read and all, and a new one takes its place.  The file is tried
+    again (after a backoff) up to FileChecksum.retries times, and then
+    given up on and listed in stalled, so one hung network mount can't hold
+    up the whole run.  Time spent waiting out a backoff doesn't count
+    towards a stall.
+"""
+import os, errno, struct, threading, time, heapq, itertools, collections, copy, logging
+import Queue
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # Windows
+from file_checksum import FileChecksum
+from utils import mtime_ns
+from exceptions import *
+
+
+# Small files get handed to the worker threads in batches of up to this many
+# files/bytes, so the pool overhead doesn't dominate
+small_batch_files = 256
+small_batch_bytes = 4*2**20
+
+READ_ORDERS = ('none', 'name', 'inode', 'physical')
+read_order = 'none'
+
+# Number of hardlinked files to remember the hash of
+inode_cache_size = 100000
+
+# Seconds a file can go without any progress before its read is given up on (None to wait forever)
+stall_timeout = None
+
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_EXTENT_UNKNOWN = 0x2 # Also set for delayed allocation
+FIEMAP_REQUEST = struct.pack('=QQLLLL', 0, 2**64-1, 0, 0, 1, 0) + b'\0'*56 # Header plus room for one extent
+
+
+class DigestCache(object):
+    """
+        Least recently used cache of hashes
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        _hash = self._entries.pop(key, None)
+        if _hash is not None:
+            self._entries[key] = _hash # Now the most recently used
+        return _hash
+
+    def put(self, key, _hash):
+        if self.max_entries <= 0:
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = _hash
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def inode_key(st):
+    """
+        Returns the key for hashes of the file with this stat, or None if there
+        aren't any other links to it to share the hash with
+    """
+    if st.st_nlink < 2:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, mtime_ns(st))
+
+
+class _Worker(object):
+    """
+        A hashing thread, and what it's up to for the stall watchdog
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.batch = None           # Batch being hashed
+        self.filename = None        # File in the batch being read right now
+        self.last_progress = None   # When it last got a chunk further
+        self.waiting_until = 0      # End of the backoff it's sleeping through before a retry
+        self.abandoned = False      # Given up on as stalled; it exits once its read returns
+
+
+class HashEngine(object):
+
+    def __init__(self, jobs=1):
+        self.jobs = max(1, jobs)
+        self.fc = FileChecksum()
+        # Progress bars from several threads would just garble each other
+        self.fc.show_progress = (self.jobs == 1)
+        self.cancel_event = None
+        self.read_order = read_order
+        self._fiemap_ok = fcntl is not None
+        self.files_hashed = 0
+        self.bytes_hashed = 0
+        self.queued_bytes = 0   # Submitted but not hashed yet (including ones being hashed right now)
+        self.queued_files = 0
+        self.files_reused = 0   # Hardlinks that got the hash of another link instead of being read
+        self.digests = DigestCache(inode_cache_size)
+        self._waiting = {}      # Key -> callbacks for the links waiting on a file with that key to be hashed
+        self.metrics = None     # Optional metrics.Metrics to record the time taken by each file
+        self.tuner = None       # Optional block_tuner.BlockTuner to pick the block size for each device
+        self.stall_timeout = stall_timeout
+        self.stalled = set()    # Files given up on after they stopped making progress
+        self.fc.on_progress = self._progress
+        self.fc.on_backoff = self._backoff
+        self._stalls = {}       # File -> times it has stalled so far
+        self._local = threading.local()
+        self._lock = threading.Lock() # Between the workers and the watchdog
+        self._watchdog = None
+        self._stop_watchdog = threading.Event()
+        self._queue = []        # Heap of (priority, seq, filename, size, callback, get_hash)
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._started_at = None
+        self._workers = []
+        self._tasks = Queue.Queue()
+        self._results = Queue.Queue()
+
+    @property
+    def show_progress(self):
+        return self.fc.show_progress
+
+    @show_progress.setter
+    def show_progress(self, value):
+        self.fc.show_progress = value and self.jobs == 1
+
+    def submit(self, filename, size, callback, key=None, get_hash=None, ino=None):
+        """
+            Queue a file for hashing.  callback gets called with the hash (None
+            if the file couldn't be read) from inside run(), or straight away
+            if the hash for key is already known.
+
+            :param key: Optional inode_key() of the file, so hardlinks only get hashed once
+            :param get_hash: Optional function of (filename, size) to read the
+                             file with instead of FileChecksum.get_hash.  callback
+                             gets whatever it returns, so don't give it a key.
+            :param ino: The file's inode number, if the caller already stat'ed it,
+                        so the inode and physical read orders don't stat it again
+        """
+        if key is not None:
+            if key in self._waiting:
+                # Another link to the same file is already queued
+                self._waiting[key].append(callback)
+                self.files_reused += 1
+                return
+            _hash = self.digests.get(key)
+            if _hash is not None:
+                self.files_reused += 1
+                callback(_hash)
+                return
+            self._waiting[key] = [callback]
+            callback = lambda _hash, key=key: self._hashed_key(key, _hash)
+        self._push(filename, size, callback, get_hash, ino)
+        self.queued_bytes += size
+        self.queued_files += 1
+
+    def _push(self, filename, size, callback, get_hash, ino=None):
+        if self.read_order != 'none':
+            priority = self._sort_key(filename, size, ino)
+        elif self.jobs > 1:
+            priority = -size # Largest first
+        else:
+            priority = 0     # In the order submitted
+        heapq.heappush(self._queue, (priority, next(self._seq), filename, size, callback, get_hash))
+
+    def _hashed_key(self, key, _hash):
+        callbacks = self._waiting.pop(key)
+        if _hash is not None:
+            self.digests.put(key, _hash)
+        for callback in callbacks:
+            callback(_hash)
+
+    @property
+    def idle(self):
+        return not self._queue and self._in_flight == 0
+
+    @property
+    def _inline(self):
+        # Hash on the calling thread, as there's no need for workers
+        return self.jobs == 1 and not self.stall_timeout
+
+    def run(self, until=None):
+        """
+            Hash queued files and call their callbacks until until() returns
+            True, or there is nothing left
+        """
+        while not self.idle:
+            if until is not None and until():
+                return
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                raise VerificationCancelled('Cancelled with %d bytes left to hash' % self.queued_bytes)
+            if self._started_at is None:
+                self._started_at = time.time()
+            if self._inline:
+                self._finish_batch(self._next_batch(), self._hash_batch)
+                continue
+            # Keep a few more tasks handed out than there are workers so nobody waits on us
+            while self._queue and self._in_flight < 2 * self.jobs:
+                self._start_workers()
+                self._tasks.put(self._next_batch())
+                self._in_flight += 1
+            worker, batch, result = self._results.get()
+            self._in_flight -= 1
+            if isinstance(result, FileStalled):
+                self._stalled(worker, batch, str(result))
+                continue
+            if isinstance(result, Exception):
+                raise result
+            self._finish_batch(batch, lambda batch: result)
+
+    def hash_files(self, filenames, sizes, keys=None, inos=None):
+        """
+            Hash a list of files and wait for them
+
+            :param filenames: Files to hash
+            :param sizes: Size of each file (used for scheduling and the progress totals)
+            :param keys: Optional inode_key() of each file
+            :param inos: Optional inode number of each file
+            :returns: The hashes in the same order as filenames, None for any file that couldn't be read
+        """
+        _hashes = [None] * len(filenames)
+        left = [len(filenames)]
+        def store(i, _hash):
+            _hashes[i] = _hash
+            left[0] -= 1
+        if keys is None:
+            keys = [None] * len(filenames)
+        if inos is None:
+            inos = [None] * len(filenames)
+        for i, (filename, size, key, ino) in enumerate(zip(filenames, sizes, keys, inos)):
+            self.submit(filename, size, lambda _hash, i=i: store(i, _hash), key, ino=ino)
+        self.run(until=lambda: left[0] == 0)
+        return _hashes
+
+    def eta(self, remaining_bytes):
+        """
+            Seconds left to hash remaining_bytes at the rate so far, or None
+            if there's no rate yet
+        """
+        if not self.bytes_hashed:
+            return None
+        return remaining_bytes * (time.time() - self._started_at) / self.bytes_hashed
+
+    def _next_batch(self):
+        """
+            Take the next task off the queue: one large file, or a run of small
+            files grouped together so the per-task overhead doesn't dominate
+        """
+        priority, seq, filename, size, callback, get_hash = heapq.heappop(self._queue)
+        batch = [(filename, size, callback, get_hash)]
+        batch_bytes = size
+        while size <= self.fc.small_file_size and self._queue and len(batch) < small_batch_files \
+                and batch_bytes < small_batch_bytes and self._queue[0][3] <= self.fc.small_file_size:
+            priority, seq, filename, size, callback, get_hash = heapq.heappop(self._queue)
+            batch.append((filename, size, callback, get_hash))
+            batch_bytes += size
+        return batch
+
+    def _finish_batch(self, batch, get_hashes):
+        _hashes = get_hashes(batch) # Raises whatever the hashing raised
+        for (filename, size, callback, get_hash), (_hash, seconds) in zip(batch, _hashes):
+            if self._stalls:
+                self._stalls.pop(filename, None)
+            self.queued_bytes -= size
+            self.queued_files -= 1
+            self.files_hashed += 1
+            self.bytes_hashed += size
+            if self.metrics is not None:
+                self.metrics.observe('hash', seconds)
+            callback(_hash)
+
+    def _hash_batch(self, batch):
+        """
+            Returns a (hash, seconds taken) for each file in the batch
+        """
+        _hashes = []
+        for i, (filename, size, callback, get_hash) in enumerate(batch):
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                raise VerificationCancelled('Cancelled before hashing %s' % filename)
+            if self._inline and i == len(batch) - 1 and self._queue and self._queue[0][3] > self.fc.small_file_size:
+                # Nothing else is reading, so get the disk started on the next big file
+                self.fc.prefetch(self._queue[0][2])
+            self._progress(filename)
+            if filename in self._stalls:
+                # Give whatever went wrong a moment to clear up
+                delay = self.fc.retry_backoff * 2**(self._stalls[filename] - 1)
+                self._backoff(delay)
+                time.sleep(delay)
+            fc, dev = self.fc, None
+            if self.tuner is not None and get_hash is None and size > self.fc.small_file_size:
+                fc, dev = self._tuned_checksum(filename, size)
+            start = time.time()
+            _hash = (get_hash or fc.get_hash)(filename, size)
+            seconds = time.time() - start
+            if dev is not None and _hash is not None:
+                self.tuner.record(dev, fc.blocksize, size, seconds)
+            _hashes.append((_hash, seconds))
+        return _hashes
+
+    def _tuned_checksum(self, filename, size):
+        """
+            Returns (FileChecksum using the tuner's block size for the file's
+            device, device), or just (self.fc, None) if it can't be stat'ed
+        """
+        try:
+            dev = os.stat(filename).st_dev
+        except OSError:
+            return self.fc, None
+        # A copy, as the other threads are using self.fc with their own block sizes
+        fc = copy.copy(self.fc)
+        fc.blocksize = self.tuner.blocksize(dev, size)
+        return fc, dev
+
+    def _start_workers(self):
+        while len(self._workers) < self.jobs:
+            worker = _Worker()
+            worker.thread = threading.Thread(target=self._worker, args=(worker,))
+            worker.thread.daemon = True
+            worker.thread.start()
+            with self._lock:
+                self._workers.append(worker)
+        if self.stall_timeout and self._watchdog is None:
+            self._stop_watchdog.clear()
+            self._watchdog = threading.Thread(target=self._watch)
+            self._watchdog.daemon = True
+            self._watchdog.start()
+
+    def _worker(self, worker):
+        self._local.worker = worker
+        while True:
+            batch = self._tasks.get()
+            if batch is None:
+                return
+            with self._lock:
+                worker.batch = batch
+                worker.filename = batch[0][0]
+                worker.last_progress = time.time()
+            try:
+                _hashes = self._hash_batch(batch)
+            except Exception as e:
+                _hashes = e
+            with self._lock:
+                if worker.abandoned:
+                    return # The watchdog already handed the batch back
+                worker.batch = None
+                self._results.put((worker, batch, _hashes))
+
+    def _progress(self, filename=None):
+        worker = getattr(self._local, 'worker', None)
+        if worker is not None:
+            worker.last_progress = time.time()
+            if filename is not None:
+                worker.filename = filename
+
+    def _backoff(self, seconds):
+        # Sleeping before a retry isn't a stall
+        worker = getattr(self._local, 'worker', None)
+        if worker is not None:
+            worker.waiting_until = time.time() + seconds
+
+    def _watch(self):
+        """
+            Hand back the batch of any worker that has stopped making progress
+        """
+        while not self._stop_watchdog.wait(min(1.0, self.stall_timeout / 4.0)):
+            now = time.time()
+            with self._lock:
+                for worker in self._workers:
+                    if worker.batch is not None and not worker.abandoned \
+                            and now - max(worker.last_progress, worker.waiting_until) > self.stall_timeout:
+                        worker.abandoned = True
+                        self._results.put((worker, worker.batch, FileStalled(worker.filename)))
+
+    def _stalled(self, worker, batch, stalled_file):
+        with self._lock:
+            self._workers.remove(worker) # A new one gets started in its place
+        for filename, size, callback, get_hash in batch:
+            if filename != stalled_file:
+                # Not hashed yet, or its hash is stuck with the abandoned worker
+                self._push(filename, size, callback, get_hash)
+                continue
+            stalls = self._stalls.get(filename, 0) + 1
+            if stalls <= self.fc.retries:
+                logging.warning("No progress reading %s for %ds, trying again" % (filename, self.stall_timeout))
+                self._stalls[filename] = stalls
+                self._push(filename, size, callback, get_hash)
+            else:
+                logging.warning("No progress reading %s for %ds, giving up on it" % (filename, self.stall_timeout))
+                self._stalls.pop(filename, None)
+                self.stalled.add(filename)
+                self.queued_bytes -= size
+                self.queued_files -= 1
+                callback(None)
+
+    def _sort_key(self, filename, size=None, ino=None):
+        # Small files aren't worth an extra open and ioctl each, so they go by inode
+        if self.read_order == 'physical' and self._fiemap_ok and (size is None or size > self.fc.small_file_size):
+            offset = self._first_physical_offset(filename)
+            if offset is not None:
+                return (0, offset)
+        if self.read_order in ('physical', 'inode'):
+            if ino is not None:
+                return (1, ino)
+            try:
+                return (1, os.stat(filename).st_ino)
+            except OSError:
+                pass
+        return (2, filename)
+
+    def _first_physical_offset(self, filename):
+        """
+            Returns where the first extent of the file starts on disk, or None
+            if it can't be found (empty or inline file, or no FIEMAP support)
+        """
+        try:
+            fd = os.open(filename, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            result = fcntl.ioctl(fd, FS_IOC_FIEMAP, FIEMAP_REQUEST)
+        except IOError as e:
+            if e.errno in (errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS):
+                # Filesystem doesn't do FIEMAP, so don't bother for the rest of the run
+                self._fiemap_ok = False
+            return None
+        finally:
+            os.close(fd)
+        mapped_extents, = struct.unpack_from('=L', result, 20)
+        if mapped_extents == 0:
+            return None
+        physical, = struct.unpack_from('=Q', result, 40)
+        flags, = struct.unpack_from('=L', result, 72)
+        if flags & FIEMAP_EXTENT_UNKNOWN:
+            return None # Not allocated on disk yet
+        return physical
+
+    def close(self):
+        """
+            Drop anything still queued and stop the worker threads.  Workers
+            still busy (after a cancel) are left to finish their file on
+            their own.
+        """
+        self._queue = []
+        self._waiting = {}
+        self.queued_bytes = 0
+        self.queued_files = 0
+        for worker in self._workers:
+            self._tasks.put(None)
+        if self._in_flight == 0:
+            for worker in self._workers:
+                worker.thread.join()
+        self._workers = []
+        if self._watchdog is not None:
+            self._stop_watchdog.set()
+            self._watchdog.join()
+            self._watchdog = None
+        self._tasks = Queue.Queue()
+        self._results = Queue.Queue()
+        self._in_flight = 0
@@ -0,0 +1,137 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Class to keep a copy of each file's hash in its extended attributes
+
+    The hash is stored in user.verifytree.hash, along with the algorithm,
+    size and mtime (in ns) of the file when it was hashed.  Extended
+    attributes move with the file when it's renamed, so a file that turns
+    up under a new name (or after its checksum file was lost) can reuse
+    its hash without being read again, as long as its size and mtime
+    haven't changed since.
+
+    Python 2 has no os.getxattr, so libc gets called through ctypes on
+    Linux.  On filesystems without user xattrs, this quietly turns itself
+    off.
+"""
+import os, sys, errno, logging
+from utils import mtime_ns
+
+
+ATTR_PREFIX = 'user.verifytree.'
+ALGORITHM = 'xxh64'
+XATTR_SIZE = 128 # Plenty for any of our values
+
+
+def _get_xattr_funcs():
+    """
+        Returns (getxattr, setxattr) functions that raise OSError/IOError on
+        failure, or (None, None) if the platform doesn't have them
+    """
+    if hasattr(os, 'getxattr'):
+        return os.getxattr, os.setxattr
+    if not sys.platform.startswith('linux'):
+        return None, None
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        c_getxattr, c_setxattr = libc.getxattr, libc.setxattr
+    except (OSError, AttributeError):
+        return None, None
+    c_getxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_size_t]
+    c_getxattr.restype = ctypes.c_ssize_t
+    c_setxattr.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_size_t, ctypes.c_int]
+
+    def getxattr(path, name):
+        buf = ctypes.create_string_buffer(XATTR_SIZE)
+        n = c_getxattr(path, name, buf, XATTR_SIZE)
+        if n < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return buf.raw[:n]
+
+    def setxattr(path, name, value):
+        if c_setxattr(path, name, value, len(value), 0) < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+
+    return getxattr, setxattr
+
+_getxattr, _setxattr = _get_xattr_funcs()
+
+# Errors that mean xattrs aren't going to work anywhere on this filesystem
+_UNSUPPORTED = set(getattr(errno, name) for name in ('ENOTSUP', 'EOPNOTSUPP', 'ENOSYS') if hasattr(errno, name))
+# Errors that just mean this file doesn't have our attributes
+_MISSING = set(getattr(errno, name) for name in ('ENODATA', 'ENOATTR') if hasattr(errno, name))
+
+
+class HashXattrs(object):
+
+    def __init__(self):
+        self.enabled = _getxattr is not None
+        self.reused = 0 # Hashes that were taken from the xattrs instead of reading the file
+
+    def get(self, filename, st):
+        """
+            Returns the hash saved on the file, or None if there isn't one or
+            the file has changed since it was saved
+
+            :param st: Current os.stat of the file
+        """
+        _hash = self._read(filename, st)
+        if _hash is not None:
+            self.reused += 1
+        return _hash
+
+    def _read(self, filename, st):
+        if not self.enabled:
+            return None
+        try:
+            _hash = _getxattr(filename, ATTR_PREFIX + 'hash')
+            if _getxattr(filename, ATTR_PREFIX + 'algo') != ALGORITHM \
+                    or int(_getxattr(filename, ATTR_PREFIX + 'size')) != st.st_size \
+                    or int(_getxattr(filename, ATTR_PREFIX + 'mtime_ns')) != mtime_ns(st):
+                return None
+        except (IOError, OSError) as e:
+            if e.errno not in _MISSING:
+                self._failed(filename, e)
+            return None
+        except ValueError:
+            return None
+        return _hash
+
+    def set(self, filename, st, _hash):
+        """
+            Save the hash on the file, unless it's already there
+        """
+        if not self.enabled or self._read(filename, st) == _hash:
+            return
+        try:
+            # Hash first: if this fails part way, the old size/mtime won't
+            # match the file any more (or the new hash is still right)
+            _setxattr(filename, ATTR_PREFIX + 'hash', _hash)
+            _setxattr(filename, ATTR_PREFIX + 'algo', ALGORITHM)
+            _setxattr(filename, ATTR_PREFIX + 'size', str(st.st_size))
+            _setxattr(filename, ATTR_PREFIX + 'mtime_ns', str(mtime_ns(st)))
+        except (IOError, OSError) as e:
+            self._failed(filename, e)
+
+    def _failed(self, filename, e):
+        if e.errno in _UNSUPPORTED:
+            # Filesystem doesn't do user xattrs, so don't bother for the rest of the run
+            logging.info("Extended attributes not supported on %s, not saving hashes in them" % filename)
+            self.enabled = False
+        else:
+            logging.debug("Could not use extended attributes on %s: %s" % (filename, e))
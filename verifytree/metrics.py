@@ -0,0 +1,216 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Class to export Prometheus metrics for a validation run
+
+    The metrics are rendered in the Prometheus text format, and can be
+    written out every so often to a file for the node-exporter textfile
+    collector (--metrics-file), and/or served over HTTP on
+    http://localhost:<port>/metrics (--metrics-port).  They cover:
+
+    - bytes and files hashed so far, and the rate since the start
+    - a latency histogram for each phase (scan, start, hash, commit)
+    - how much is still queued on the hash engine
+    - a count of every kind of finding (files_chksum_error, files_new, ...)
+    - when the run started and when the last file was hashed, to alert on
+      stuck runs
+"""
+import os, time, threading, logging
+import BaseHTTPServer
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+PHASES = ('scan', 'start', 'hash', 'commit')
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets) # Not cumulative; that gets done when rendering
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class Metrics(object):
+
+    def __init__(self, engine=None):
+        self.engine = engine    # HashEngine to read the live totals and queue depth from
+        self.phases = dict((phase, Histogram()) for phase in PHASES)
+        self.findings = {}      # Finding kind -> count
+        self.dirs_done = 0
+        self.started_at = time.time()
+        self.last_progress = None
+        self.running = True
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._writer = None
+        self._server = None
+        self.textfile = None
+
+    def observe(self, phase, seconds):
+        with self._lock:
+            self.phases[phase].observe(seconds)
+            if phase == 'hash':
+                self.last_progress = time.time()
+
+    def observe_finding(self, finding):
+        with self._lock:
+            self.findings[finding.kind] = self.findings.get(finding.kind, 0) + 1
+
+    def dir_done(self):
+        with self._lock:
+            self.dirs_done += 1
+
+    def render(self):
+        """
+            Returns all the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        def metric(name, kind, help, samples):
+            lines.append('# HELP verifytree_%s %s' % (name, help))
+            lines.append('# TYPE verifytree_%s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                labels = '{%s}' % ','.join('%s="%s"' % label for label in labels) if labels else ''
+                lines.append('verifytree_%s%s%s %s' % (name, suffix, labels, _format_value(value)))
+
+        with self._lock:
+            elapsed = max(time.time() - self.started_at, 1e-6)
+            engine = self.engine
+            files_hashed = engine.files_hashed if engine else 0
+            bytes_hashed = engine.bytes_hashed if engine else 0
+            metric('bytes_hashed_total', 'counter', 'Bytes hashed so far',
+                   [('', None, bytes_hashed)])
+            metric('files_hashed_total', 'counter', 'Files hashed so far',
+                   [('', None, files_hashed)])
+            metric('files_per_second', 'gauge', 'Files hashed per second since the start of the run',
+                   [('', None, files_hashed / elapsed)])
+            metric('bytes_per_second', 'gauge', 'Bytes hashed per second since the start of the run',
+                   [('', None, bytes_hashed / elapsed)])
+            metric('dirs_done_total', 'counter', 'Directories finished so far',
+                   [('', None, self.dirs_done)])
+            if engine:
+                metric('queue_bytes', 'gauge', 'Bytes queued on the hash engine but not hashed yet',
+                       [('', None, engine.queued_bytes)])
+                metric('queue_files', 'gauge', 'Files queued on the hash engine but not hashed yet',
+                       [('', None, engine.queued_files)])
+            metric('findings_total', 'counter', 'Findings by kind (files_chksum_error, files_disk_error, ...)',
+                   [('', (('kind', kind),), n) for kind, n in sorted(self.findings.items())])
+            samples = []
+            for phase in PHASES:
+                histogram = self.phases[phase]
+                cumulative = 0
+                for bound, n in zip(histogram.buckets, histogram.counts):
+                    cumulative += n
+                    samples.append(('_bucket', (('phase', phase), ('le', _format_value(bound))), cumulative))
+                samples.append(('_bucket', (('phase', phase), ('le', '+Inf')), histogram.count))
+                samples.append(('_sum', (('phase', phase),), histogram.sum))
+                samples.append(('_count', (('phase', phase),), histogram.count))
+            metric('phase_seconds', 'histogram', 'Time taken by each directory scan, directory start, file hash and checksum file commit',
+                   samples)
+            metric('start_time_seconds', 'gauge', 'When the run started (unix time)',
+                   [('', None, self.started_at)])
+            metric('last_progress_time_seconds', 'gauge', 'When the last file was hashed (unix time)',
+                   [('', None, self.last_progress or self.started_at)])
+            metric('running', 'gauge', '1 while the run is going, 0 once it has finished',
+                   [('', None, 1 if self.running else 0)])
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, filename=None):
+        """
+            Write the metrics out for the node-exporter textfile collector.  It
+            goes to a temporary file that's renamed into place, so the collector
+            never sees a half-written file.
+        """
+        filename = filename or self.textfile
+        tmp_file = '%s.tmp.%d' % (filename, os.getpid())
+        with open(tmp_file, 'w') as f:
+            f.write(self.render())
+        os.rename(tmp_file, filename)
+
+    def start(self, textfile=None, port=None, interval=15):
+        """
+            Start writing the textfile every interval seconds and/or serving
+            the metrics over HTTP on localhost:port
+        """
+        self.textfile = textfile
+        if textfile:
+            self._writer = threading.Thread(target=self._write_loop, args=(interval,))
+            self._writer.daemon = True
+            self._writer.start()
+        if port is not None:
+            self._server = BaseHTTPServer.HTTPServer(('127.0.0.1', port), _make_handler(self))
+            server_thread = threading.Thread(target=self._server.serve_forever)
+            server_thread.daemon = True
+            server_thread.start()
+
+    def close(self):
+        """
+            Mark the run as finished, write the textfile one last time and stop
+            the HTTP server
+        """
+        self.running = False
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+        if self.textfile:
+            self.write_textfile()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _write_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.write_textfile()
+            except (IOError, OSError) as e:
+                logging.warning("Could not write metrics to %s: %s" % (self.textfile, e))
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _make_handler(metrics):
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return MetricsHandler
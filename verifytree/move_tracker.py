@@ -0,0 +1,86 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Class to match up files that were moved or renamed during a run
+
+    While the tree is walked, files that are missing from where their
+    checksum file says they should be, and new files that no checksum file
+    knows about, are both held back here instead of being reported right
+    away.  Once the whole tree has been walked, a missing file and a new
+    file with the same inode, size and mtime are taken to be the same file
+    moved somewhere else: the new path gets the old hash without being read
+    again.  Whatever is left over is reported as deleted or new as usual.
+"""
+import os
+
+
+class MoveTracker(object):
+
+    def __init__(self):
+        self.missing = {}   # (ino, size, mtime) -> [(directory, name, entry)] for files gone from their directory
+        self.new = []       # (directory, name, (ino, size, mtime)) for files no checksum file knew about
+
+    def add_missing(self, directory, name, entry):
+        """
+            Hold back a file that's in the checksum file but not on disk.
+            Returns False if the entry is too old to have an inode recorded,
+            in which case it can't be matched and should be reported now.
+        """
+        if 'ino' not in entry:
+            return False
+        key = (entry['ino'], long(entry['size']), entry['mtime'])
+        self.missing.setdefault(key, []).append((directory, name, entry))
+        return True
+
+    def add_new(self, directory, name, st):
+        self.new.append((directory, name, (st.st_ino, st.st_size, st.st_mtime)))
+
+    def resolve(self):
+        """
+            Match up the files held back during the walk
+
+            :returns: Dict of directory -> :class:`Moves` for every directory with any
+        """
+        by_dir = {}
+        def moves(directory):
+            return by_dir.setdefault(directory, Moves())
+        for directory, name, key in self.new:
+            if not self.missing.get(key):
+                moves(directory).new.add(name)
+            else:
+                src_dir, src_name, entry = self.missing[key].pop()
+                moves(directory).moved_in[name] = (os.path.join(src_dir, src_name), entry)
+                moves(src_dir).moved_out.add(src_name)
+        for srcs in self.missing.values():
+            for directory, name, entry in srcs:
+                moves(directory).missing.add(name)
+        self.missing = {}
+        self.new = []
+        return by_dir
+
+
+class Moves(object):
+    """
+        What was held back for one directory
+    """
+
+    def __init__(self):
+        self.new = set()        # Really new files
+        self.missing = set()    # Really deleted files
+        self.moved_in = {}      # Name -> (old path, old entry) of files moved here
+        self.moved_out = set()  # Files moved somewhere else
+
+    def names(self):
+        return self.new | self.missing | self.moved_out | set(self.moved_in)
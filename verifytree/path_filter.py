@@ -0,0 +1,249 @@
+# Copyright 2015 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+""" Class to decide which files and directories to skip
+
+    Rules are written like .gitignore lines, and matched against the path
+    relative to the top of the tree:
+
+    - ``*.tmp`` excludes every file or directory called that, at any depth
+    - ``cache/`` (trailing slash) only matches directories
+    - ``/scratch`` or ``a/b`` (any slash other than a trailing one) is
+      anchored to the top of the tree
+    - ``**/`` matches any number of directories, and ``/**`` everything inside
+    - ``!pattern`` puts back something an earlier rule excluded
+    - the last rule that matches wins, and blank lines and ``#`` comments
+      are ignored
+
+    All the rules get compiled into a couple of regular expressions up
+    front.  An excluded directory is pruned before it gets listed, so
+    nothing under it can be put back.  Files can also be skipped by size
+    and age, which needs a stat, so those are checked after the name rules.
+
+    Excluded files and directories are left out of the checks, but anything
+    already saved in a checksum file for them is kept as it is, so changing
+    the rules never looks like files being deleted.
+"""
+import os, re, time, hashlib
+
+
+# Python 2 regular expressions can't have more than 100 groups
+_RULES_PER_REGEX = 90
+
+
+def read_rules(filename):
+    with open(filename) as f:
+        return f.read().splitlines()
+
+
+def same_filter(path_filter, hashes):
+    """
+        True if the listing saved in hashes was made with the same rules as
+        path_filter (which can be None), so it can be reused
+    """
+    if path_filter is None:
+        return hashes.get('filter') is None
+    return not path_filter.needs_stat and hashes.get('filter') == path_filter.signature
+
+
+def _prefix(rel_dir):
+    return '' if rel_dir in ('', '.') else rel_dir.replace(os.sep, '/') + '/'
+
+
+def _translate(pattern):
+    """
+        Returns the regular expression for the glob part of a rule
+    """
+    res = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            res.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            res.append('.*')
+            i += 2
+        elif c == '*':
+            res.append('[^/]*')
+            i += 1
+        elif c == '?':
+            res.append('[^/]')
+            i += 1
+        elif c == '[':
+            j = pattern.find(']', i + 2)
+            if j == -1:
+                res.append(re.escape(c))
+                i += 1
+                continue
+            chars = pattern[i+1:j].replace('\\', '\\\\')
+            if chars[0] in '!^':
+                chars = '^' + chars[1:]
+            res.append('[%s]' % chars)
+            i = j + 1
+        elif c == '\\' and i + 1 < n:
+            res.append(re.escape(pattern[i+1]))
+            i += 2
+        else:
+            res.append(re.escape(c))
+            i += 1
+    return ''.join(res)
+
+
+def _parse_rule(line):
+    """
+        Returns (regex, directories only, re-include) for a rule, or None for
+        blank lines and comments
+    """
+    line = line.rstrip()
+    if not line or line.startswith('#'):
+        return None
+    negate = line.startswith('!')
+    if negate:
+        line = line[1:]
+    elif line.startswith('\\'):
+        line = line[1:] # \# and \! are literal
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    anchored = '/' in line
+    line = line.lstrip('/')
+    regex = _translate(line)
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return regex, dir_only, negate
+
+
+class _Matcher(object):
+    """
+        The rules for one kind of path (files or directories), as a few
+        big alternations with the last rule first
+    """
+
+    def __init__(self, rules):
+        rules = rules[::-1]
+        self.chunks = []
+        for start in range(0, len(rules), _RULES_PER_REGEX):
+            chunk = rules[start:start+_RULES_PER_REGEX]
+            regex = re.compile(r'\A(?:%s)\Z' % '|'.join('(%s)' % r for r, negate in chunk), re.DOTALL)
+            self.chunks.append((regex, [negate for r, negate in chunk]))
+
+    def excluded(self, path):
+        for regex, negates in self.chunks:
+            m = regex.match(path)
+            if m:
+                return not negates[m.lastindex - 1]
+        return False
+
+
+class PathFilter(object):
+
+    def __init__(self, rules=(), min_size=None, max_size=None, min_age=None, max_age=None):
+        """
+            :param rules: .gitignore style lines
+            :param min_size: Skip files smaller than this many bytes
+            :param max_size: Skip files bigger than this many bytes
+            :param min_age: Skip files modified less than this many seconds ago
+            :param max_age: Skip files modified more than this many seconds ago
+        """
+        self.rules = [r for r in rules if _parse_rule(r) is not None]
+        parsed = [_parse_rule(r) for r in self.rules]
+        self._dirs = _Matcher([(regex, negate) for regex, dir_only, negate in parsed])
+        self._files = _Matcher([(regex, negate) for regex, dir_only, negate in parsed if not dir_only])
+        self.min_size = min_size
+        self.max_size = max_size
+        now = time.time()
+        self.newest_mtime = now - min_age if min_age is not None else None
+        self.oldest_mtime = now - max_age if max_age is not None else None
+
+    @property
+    def needs_stat(self):
+        return any(x is not None for x in (self.min_size, self.max_size, self.newest_mtime, self.oldest_mtime))
+
+    @property
+    def signature(self):
+        """
+            Identifies the rules, so a listing saved under different rules
+            doesn't get reused.  Listings made while checking sizes or ages
+            never get reused, as those change without the directory being
+            modified.
+        """
+        return hashlib.sha1('\n'.join(self.rules)).hexdigest()[:16]
+
+    def excluded(self, path, is_dir=False):
+        """
+            :param path: Path relative to the top of the tree, with / separators
+        """
+        return (self._dirs if is_dir else self._files).excluded(path)
+
+    def excluded_path(self, path):
+        """
+            Like excluded, but also checks every directory above the file
+        """
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            if self._dirs.excluded('/'.join(parts[:i])):
+                return True
+        return self._files.excluded(path)
+
+    def excluded_size(self, size, mtime):
+        if self.min_size is not None and size < self.min_size:
+            return True
+        if self.max_size is not None and size > self.max_size:
+            return True
+        if self.newest_mtime is not None and mtime > self.newest_mtime:
+            return True
+        if self.oldest_mtime is not None and mtime < self.oldest_mtime:
+            return True
+        return False
+
+    def excluded_record(self, rel_dir, name, entry=None, is_dir=False):
+        """
+            True if a file or directory saved in the checksum file for rel_dir
+            is left out.  The size and age checks go by the saved entry, for
+            files that are no longer there to stat.
+        """
+        if self.excluded(_prefix(rel_dir) + name, is_dir):
+            return True
+        return entry is not None and self.excluded_size(long(entry['size']), entry['mtime'])
+
+    def filter_listing(self, rel_dir, dirs, files, root=None, keep=None):
+        """
+            Returns the dirs and files in a directory listing that aren't excluded
+
+            :param rel_dir: Directory relative to the top of the tree ('' or '.' for the top)
+            :param root: Where the directory actually is, to stat the files for
+                         the size and age checks
+            :param keep: File name that never gets excluded (the checksum file)
+        """
+        prefix = _prefix(rel_dir)
+        dirs = [d for d in dirs if not self._dirs.excluded(prefix + d)]
+        kept = []
+        for f in files:
+            if f == keep:
+                kept.append(f)
+                continue
+            if self._files.excluded(prefix + f):
+                continue
+            if self.needs_stat:
+                try:
+                    st = os.stat(os.path.join(root, f))
+                except OSError:
+                    continue
+                if self.excluded_size(st.st_size, st.st_mtime):
+                    continue
+            kept.append(f)
+        return dirs, kept
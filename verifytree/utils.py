@@ -1,6 +1,46 @@
-import sys
+import sys, os
 
 def error(msg):
     print ("ERROR: %s" % msg)
     sys.exit(-1)
 
+def format_duration(seconds):
+    h = int(seconds / (60*60))
+    m = int((seconds - h*60*60) / 60)
+    s = int(seconds - h*60*60 - m*60)
+    return "%dh %dm %ds" % (h, m, s)
+
+def mtime_ns(st):
+    """
+        Returns the mtime from a stat result in nanoseconds.  Python 2 only has
+        the float, which is good to about a microsecond.
+    """
+    if hasattr(st, 'st_mtime_ns'):
+        return st.st_mtime_ns
+    return int(round(st.st_mtime * 1e6)) * 1000
+
+def get_dir_stat(path):
+    """
+        Returns the parts of a directory's stat that change whenever an entry
+        is added, removed or renamed in it
+    """
+    st = os.stat(path)
+    return {'mtime_ns': mtime_ns(st), 'ino': st.st_ino}
+
+# Directory mtimes only move in steps (a second on many filesystems, two
+# on FAT), so an entry made in the same step just after a listing leaves the
+# mtime as it was.  Listings taken this soon after the mtime aren't trusted.
+RACY_MTIME_SECONDS = 2
+
+def is_racy_dir_stat(dir_stat, listed_at):
+    """
+        True if the directory was modified too close to when it was listed
+        (at time listed_at) to be sure the listing caught everything
+    """
+    return listed_at - dir_stat['mtime_ns'] / 1e9 < RACY_MTIME_SECONDS
+
+def same_dir_stat(a, b):
+    # Allow a couple of microseconds of slack for the float round-trip on Python 2
+    if not a or not b:
+        return False
+    return a['ino'] == b['ino'] and abs(a['mtime_ns'] - b['mtime_ns']) < 2000
@@ -16,18 +16,69 @@
 """Verify that two trees have identical files.
 
 Usage:
-    verifytree [options] checksum <file>
-    verifytree [options] validate <dir> [-u] [--no-subdirs]
+    verifytree [options] checksum [-c] [-0] [<file>...]
+    verifytree [options] validate <dir> [-u] [--no-subdirs] [--from-list <list>]
     verifytree [options] freshen <dir> [-u] [--no-subdirs]
     verifytree [options] scan <dir>
+    verifytree [options] audit <dir> [--sample <n>] [--by-size] [--confidence <pct>] [--seed <n>]
 
 Options:
     -v --verbose            Verbose logging
     -d --debug              Debug logging
-    -b <blocksize>          File chunk size [default: 1048576]
+    -b <blocksize>          File chunk size, or "auto" to time a few sizes on the first
+                            large files of each device and keep the fastest [default: 1048576]
+    --tuning-file <file>    Where -b auto keeps the block size it picked for each
+                            mount [default: ~/.verifytree_tuning.yaml]
+    -j --jobs <n>           Number of files to hash in parallel [default: 1]
+    --io-mode <mode>        How to read files: buffered, nocache (drop from the
+                            page cache after hashing) or direct (O_DIRECT) [default: buffered]
+    --read-ahead <n>        Chunks to read ahead of the hashing on a separate thread,
+                            0 to read and hash in turn [default: 4]
+    --read-order <order>    Order to read queued files in: none, name, inode or
+                            physical (disk offset, for spinning disks) [default: none]
+    --lookahead <GB>        With -j, how much data to queue up from the directories
+                            ahead of the one being reported on [default: 16]
+    --xattrs                Keep a copy of each hash in the file's user.verifytree.*
+                            extended attributes, and reuse it for renamed or moved files
+    --detect-moves          Match files missing from one place with new files elsewhere
+                            by inode, size and mtime, and keep their hash instead of
+                            reading them again
+    --archives              Also hash each member of .tar, .tar.gz, .tgz, .tar.bz2 and
+                            .zip files, so damaged members can be pinpointed
+    --stall-timeout <s>     Give up on a read that makes no progress for this many
+                            seconds (e.g. a hung NFS mount), 0 to wait forever [default: 0]
+    --retries <n>           Times to retry a file that fails to read or stalls [default: 2]
+    --inode-cache <n>       Number of hardlinked files to remember the hash of, so
+                            each one is only read once (0 to turn off) [default: 100000]
+    -c --check              Read checksum lines from the files (or stdin) and check them
+    -0 --null               File names on stdin (or in the --from-list file) are
+                            separated by NUL (find -print0) instead of newlines
     -u                      Update checksum files
     -f                      Force update checksum files
+    --fsync-batch <n>       Number of checksum files to fsync together [default: 1]
+    --fast-scan             Reuse the saved file list of directories that haven't changed
+                            (writing a checksum file then keeps its directory's mtime)
     --no-subdirs            Don't descend into sub-directories 
+    --exclude <patterns>    Comma separated .gitignore style patterns of files and
+                            directories to skip, e.g. ".snapshot/,cache/,*.tmp"
+    --filter-file <file>    File of .gitignore style rules of what to skip ("!" puts
+                            back something excluded earlier)
+    --min-size <bytes>      Skip files smaller than this
+    --max-size <bytes>      Skip files bigger than this
+    --min-age <days>        Skip files modified less than this many days ago
+    --max-age <days>        Skip files modified more than this many days ago
+    --from-list <list>      Only check the files named in this file ("-" for stdin),
+                            relative to <dir>, e.g. the ones an rsync just copied
+    --sample <n>            Number of files to hash for an audit [default: 1000]
+    --by-size               Draw the audit's files in proportion to their size (a big
+                            file can come up more than once), so the rate is of
+                            the data rather than of the files
+    --confidence <pct>      Confidence level of the audit's interval: 90, 95 or 99 [default: 95]
+    --seed <n>              Seed for picking the audit's files, to repeat an audit
+    --metrics-file <file>   Keep writing Prometheus metrics to this file (for the
+                            node-exporter textfile collector)
+    --metrics-port <port>   Serve Prometheus metrics on http://localhost:<port>/metrics
+    --metrics-interval <s>  Seconds between metrics file updates [default: 15]
 
 """
 
@@ -36,15 +87,13 @@ import sys, os, logging, shutil, time
 from filecmp import dircmp
 
 from version import __version__
-from utils import error
+from utils import error, format_duration
 
-# External pkg imports
-import docopt
-import yaml
-import hashlib, xxhash, frogress
+# External pkg imports.  Only the ones every command needs are imported up
+# front, so that checksum starts quickly
 import file_checksum
-import dir_checksum
-import check_dirs
+import hash_engine
+from hash_engine import HashEngine
 
 
 """
@@ -66,6 +115,16 @@ class VerifyTree(object):
         self.update_hash_files = False
         self.force_update_hash_files = False
         self.freshen_hash_files = False
+        self.fsync_batch = 1
+        self.fast_scan = False
+        self.jobs = 1
+        self.lookahead = 16
+        self.from_list = None
+        self.path_filter = None
+        self.metrics_file = None
+        self.metrics_port = None
+        self.metrics_interval = 15
+        self.exit_status = 0
         self.timing = { 'start': 0,
                         'end': 0,
                       }
@@ -79,6 +138,7 @@ class VerifyTree(object):
            :returns: dict of yaml file
            :rtype: dict
         """
+        import yaml
         with config_file:
             myconfig = yaml.load(config_file)
         return myconfig
@@ -116,12 +176,31 @@ class VerifyTree(object):
         if argv['--debug']:
             logging.basicConfig(level=logging.DEBUG, format='%(message)s')                
 
-        if self.args['-b']:
+        self.block_tuner = None
+        if self.args['-b'] == 'auto':
+            from block_tuner import BlockTuner
+            file_checksum.blocksize = 1048576 # Until each device has been tuned
+            self.block_tuner = BlockTuner(os.path.expanduser(self.args['--tuning-file']),
+                                          default=file_checksum.blocksize)
+        elif self.args['-b']:
             self.blocksize = int(self.args['-b'])
             file_checksum.blocksize = self.blocksize
 
+        if self.args['--io-mode'] not in file_checksum.IO_MODES:
+            error("--io-mode must be one of %s" % ', '.join(file_checksum.IO_MODES))
+        file_checksum.io_mode = self.args['--io-mode']
+        file_checksum.read_ahead = int(self.args['--read-ahead'])
+
+        if self.args['--read-order'] not in hash_engine.READ_ORDERS:
+            error("--read-order must be one of %s" % ', '.join(hash_engine.READ_ORDERS))
+        hash_engine.read_order = self.args['--read-order']
+        hash_engine.inode_cache_size = int(self.args['--inode-cache'])
+        hash_engine.stall_timeout = float(self.args['--stall-timeout']) or None
+        file_checksum.retries = int(self.args['--retries'])
+
         if self.args['checksum']:
-            self.file_to_checksum = self.args['<file>']
+            self.files_to_checksum = self.args['<file>']
+            self.jobs = int(self.args['--jobs'])
         elif self.args['validate'] or self.args['freshen']:
             self.dir_to_validate = self.args['<dir>']
             if not os.path.isdir(self.dir_to_validate):
@@ -132,9 +211,53 @@ class VerifyTree(object):
                 self.force_update_hash_files = True
             if self.args['freshen']:
                 self.freshen_hash_files = True
+            self.fsync_batch = int(self.args['--fsync-batch'])
+            self.fast_scan = self.args['--fast-scan']
+            self.from_list = self.args['--from-list']
+            self.jobs = int(self.args['--jobs'])
+            self.lookahead = float(self.args['--lookahead'])
+            self.metrics_file = self.args['--metrics-file']
+            if self.args['--metrics-port']:
+                self.metrics_port = int(self.args['--metrics-port'])
+            self.metrics_interval = float(self.args['--metrics-interval'])
 
         elif self.args['scan']:
             self.dir_to_validate = self.args['<dir>']
+        elif self.args['audit']:
+            self.dir_to_validate = self.args['<dir>']
+            if not os.path.isdir(self.dir_to_validate):
+                error("%s not found" % self.dir_to_validate)
+            self.jobs = int(self.args['--jobs'])
+            if int(self.args['--confidence']) not in (90, 95, 99):
+                error("--confidence must be one of 90, 95 or 99")
+
+        self.path_filter = self._get_path_filter()
+
+    def _get_engine(self):
+        engine = HashEngine(self.jobs)
+        engine.tuner = self.block_tuner
+        return engine
+
+    def _get_path_filter(self):
+        """
+            Returns a PathFilter for the --exclude, --filter-file, size and age
+            options, or None if none of them were given
+        """
+        rules = []
+        if self.args['--filter-file']:
+            from path_filter import read_rules
+            rules.extend(read_rules(self.args['--filter-file']))
+        if self.args['--exclude']:
+            rules.extend(self.args['--exclude'].split(','))
+        limits = {}
+        for option, name, scale in (('--min-size', 'min_size', 1), ('--max-size', 'max_size', 1),
+                                    ('--min-age', 'min_age', 24*60*60), ('--max-age', 'max_age', 24*60*60)):
+            if self.args[option] is not None:
+                limits[name] = float(self.args[option]) * scale
+        if not rules and not limits:
+            return None
+        from path_filter import PathFilter
+        return PathFilter(rules, **limits)
 
 
     def run_compare(self, dcmp, level):
@@ -159,10 +282,7 @@ class VerifyTree(object):
     def report_timing(self):
         #print("="*40)
         duration = self.timing['end'] - self.timing['start']
-        h = int(duration / (60*60))
-        m = int((duration - h*60*60) / 60)
-        s = int(duration - h*60*60 - m*60)
-        print("\nElapsed time: %dh %dm %ds\n" % (h,m,s))
+        print("\nElapsed time: %s\n" % format_duration(duration))
         #print("="*40)
         
         
@@ -182,16 +302,35 @@ class VerifyTree(object):
         self.timing['start'] = time.time()
 
         if self.args['checksum']:
-            fc = file_checksum.FileChecksum()
-            print ("Checksumming %s" % (self.file_to_checksum), end='')
-            #print (self._get_hash(self.file_to_checksum))
-            print (fc.get_hash(self.file_to_checksum))
+            # Nothing else goes to stdout, so the output can be checked with xxhsum -c too
+            sys.exit(self.checksum_files())
         elif self.args['validate'] or self.args['freshen']:
+            import check_dirs
+            from metrics import Metrics
             # Scan the directory
             checker = check_dirs.CheckDirs()
-            print("Building file list:")
-            num_dirs, num_files, size_files = checker.scan(self.dir_to_validate)
-            print("%d dirs, %d files, %7.2fGB" % (num_dirs, num_files, float(size_files)/(2**30)))
+            checker.fsync_batch = self.fsync_batch
+            checker.fast_scan = self.fast_scan
+            checker.path_filter = self.path_filter
+            checker.detect_moves = self.args['--detect-moves']
+            checker.archives = self.args['--archives']
+            if self.args['--xattrs']:
+                from hash_xattrs import HashXattrs
+                checker.xattrs = HashXattrs()
+            checker.engine = self._get_engine()
+            if self.jobs > 1:
+                checker.lookahead_bytes = int(self.lookahead * 2**30)
+            metrics = None
+            if self.metrics_file or self.metrics_port is not None:
+                metrics = Metrics(checker.engine)
+                checker.metrics = metrics
+                checker.engine.metrics = metrics
+                checker.listener = metrics.observe_finding
+                metrics.start(self.metrics_file, self.metrics_port, self.metrics_interval)
+            if not self.from_list:
+                print("Building file list:")
+                num_dirs, num_files, size_files = checker.scan(self.dir_to_validate)
+                print("%d dirs, %d files, %7.2fGB" % (num_dirs, num_files, float(size_files)/(2**30)))
 
             if self.force_update_hash_files:
                 print("Force updating checksum files")
@@ -204,21 +343,90 @@ class VerifyTree(object):
                 print("Only freshening checksums for new files since last scan")
                 checker.freshen_hash_files = self.freshen_hash_files
 
-            if self.args['--no-subdirs']:
-                checker.validate_single_directory(self.dir_to_validate)
-            else:
-                checker.validate(self.dir_to_validate)
+            try:
+                if self.from_list:
+                    from checksum_files import read_file_list
+                    if self.from_list == '-':
+                        checker.validate(self.dir_to_validate, read_file_list(sys.stdin, self.args['--null']))
+                    else:
+                        with open(self.from_list) as f:
+                            checker.validate(self.dir_to_validate, read_file_list(f, self.args['--null']))
+                elif self.args['--no-subdirs']:
+                    checker.validate_single_directory(self.dir_to_validate)
+                else:
+                    checker.validate(self.dir_to_validate)
+            finally:
+                if metrics is not None:
+                    metrics.close()
         elif self.args['scan']:
             pass
+        elif self.args['audit']:
+            self.exit_status = self.audit()
         else:
             error("Shouldn't be here!")
 
         self.timing['end'] = time.time()
         self.report_timing()
+        if self.exit_status:
+            sys.exit(self.exit_status)
             
 
 
+    def checksum_files(self):
+        """
+            Checksum the files given (or listed on stdin), or with --check,
+            check the checksum lines in them
+
+            :returns: Exit status; 1 if anything failed
+        """
+        from checksum_files import ChecksumFiles, read_file_list
+        checker = ChecksumFiles(self._get_engine())
+        from_stdin = not self.files_to_checksum or self.files_to_checksum == ['-']
+        try:
+            if self.args['--check']:
+                if from_stdin:
+                    lines = sys.stdin
+                else:
+                    lines = (line for f in self.files_to_checksum for line in open(f))
+                mismatches, errors = checker.check(lines)
+                return 1 if mismatches or errors else 0
+
+            if from_stdin:
+                filenames = read_file_list(sys.stdin, self.args['--null'])
+            else:
+                filenames = self.files_to_checksum
+            return 1 if checker.checksum(filenames) else 0
+        finally:
+            checker.engine.close()
+
+
+    def audit(self):
+        """
+            Hash a random sample of the files recorded under the directory and
+            print the failure rate, with a confidence interval for the whole tree
+
+            :returns: Exit status; 1 if any of the sample failed
+        """
+        from audit import Audit
+        auditor = Audit(self._get_engine())
+        auditor.path_filter = self.path_filter
+        seed = int(self.args['--seed']) if self.args['--seed'] else None
+        try:
+            results = auditor.audit(self.dir_to_validate, int(self.args['--sample']), self.args['--by-size'],
+                                    int(self.args['--confidence']), seed)
+        finally:
+            auditor.engine.close()
+        for filename, kind in results.failed:
+            if kind == 'unreadable':
+                print("ERROR: file %s could not be read" % filename)
+            else:
+                print("ERROR: file %s hash has changed" % filename)
+        print(results)
+        return 1 if results.failures else 0
+
+
 def main():
+    import docopt
     args = docopt.docopt(__doc__, version='Verifytree %s' % __version__)
     script = VerifyTree()
     script.go(args)